@@ -1,36 +1,303 @@
 from abc import ABC, abstractmethod
-import google.generativeai as genai
+from collections import OrderedDict
+from enum import IntEnum
+from typing import Iterator
+import asyncio
+import concurrent.futures
+import hashlib
+import heapq
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import weakref
+from metrics import metrics
+from response_cache import ResponseCache
+
+class Priority(IntEnum):
+    '''Scheduling class of a model call; lower values are served first'''
+    INTERACTIVE = 0 # Dialogue and narration the player is waiting on
+    BACKGROUND = 1 # Summaries and memory compaction
+    PREFETCH = 2 # Speculative work that may never be used
+
+class ProviderError(Exception):
+    '''A failed provider call; retriable marks transient failures such as rate limits'''
+
+    def __init__(self, message: str, retriable: bool = False):
+        super().__init__(message)
+        self.retriable = retriable
+
+class FlightAbandoned(Exception):
+    '''The caller making a shared request was cancelled; whoever was waiting on it should retry'''
+
+class DeadlineExceeded(ProviderError):
+    '''The call could not finish before its deadline'''
+
+# HTTP status codes worth retrying: timeouts, rate limits and server-side failures
+RETRIABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+def is_retriable(error: BaseException) -> bool:
+    if isinstance(error, ProviderError):
+        return error.retriable
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    # google.api_core exceptions carry the HTTP status in .code
+    return getattr(error, 'code', None) in RETRIABLE_STATUS_CODES
+
+def is_rate_limited(error: BaseException) -> bool:
+    return getattr(error, 'code', None) == 429
 
 class AIProvider(ABC):
     '''Abstract base class for AI providers'''
 
     @abstractmethod
-    def generate_content(self, prompt: str, max_tokens: int = 300, temperature: float = 1.0) -> str:
+    def generate_content(self, prompt: str, max_tokens: int = 300, temperature: float = 1.0,
+                         system_instruction: str = None) -> str:
         '''Generate content using the AI provider'''
         pass
 
+    def generate_content_stream(self, prompt: str, max_tokens: int = 300, temperature: float = 1.0,
+                                system_instruction: str = None) -> Iterator[str]:
+        '''
+        Generate content as a stream of text chunks
+
+        Providers without native streaming yield the whole response as one chunk.
+        '''
+        text = self.generate_content(prompt, max_tokens, temperature, system_instruction)
+        if text:
+            yield text
+
+    async def generate_content_async(self, prompt: str, max_tokens: int = 300, temperature: float = 1.0,
+                                     system_instruction: str = None) -> str:
+        '''
+        Generate content without blocking the event loop
+
+        Providers without a native async client run generate_content in a worker thread.
+        '''
+        return await asyncio.to_thread(
+            self.generate_content, prompt, max_tokens, temperature, system_instruction
+        )
+
+    def start_chat(self, system_instruction: str = None, history: list = None) -> 'ChatSession':
+        '''
+        Start a multi-turn chat
+
+        Args:
+            history: Earlier turns as [{'role': 'user' | 'assistant', 'content': str}]
+        '''
+        return ChatSession(self, system_instruction, history)
+
+class ChatSession:
+    '''
+    A multi-turn conversation with a provider
+
+    This generic version sends the transcript so far with each message, for
+    providers without a native chat API.
+    '''
+
+    def __init__(self, provider: AIProvider, system_instruction: str = None, history: list = None):
+        self.provider = provider
+        self.system_instruction = system_instruction
+        self.history = list(history or [])
+
+    def _prompt(self, message: str) -> str:
+        turns = [f"{turn['role']}: {turn['content']}" for turn in self.history]
+        turns.append(f'user: {message}')
+        return '\n'.join(turns)
+
+    def _record(self, message: str, response: str):
+        self.history.append({ 'role': 'user', 'content': message })
+        self.history.append({ 'role': 'assistant', 'content': response })
+
+    def send_message(self, message: str, max_tokens: int = 300, temperature: float = 1.0) -> str:
+        '''Send a message and return the reply'''
+        response = self.provider.generate_content(
+            self._prompt(message), max_tokens, temperature, self.system_instruction
+        )
+        if response:
+            self._record(message, response)
+        return response
+
+    def send_message_stream(self, message: str, max_tokens: int = 300, temperature: float = 1.0) -> Iterator[str]:
+        '''Send a message and stream the reply in chunks'''
+        chunks = []
+        for chunk in self.provider.generate_content_stream(
+            self._prompt(message), max_tokens, temperature, self.system_instruction
+        ):
+            chunks.append(chunk)
+            yield chunk
+        if chunks:
+            self._record(message, ''.join(chunks))
+
+    async def send_message_async(self, message: str, max_tokens: int = 300, temperature: float = 1.0) -> str:
+        '''Send a message without blocking the event loop'''
+        response = await self.provider.generate_content_async(
+            self._prompt(message), max_tokens, temperature, self.system_instruction
+        )
+        if response:
+            self._record(message, response)
+        return response
+
+def _genai():
+    '''
+    The google.generativeai module, imported on first use: it takes most of a
+    second to import, which other providers and short-lived processes should
+    not pay for
+    '''
+    import google.generativeai as genai
+    return genai
+
+class ModelPool:
+    '''
+    Bounded LRU pool of configured Gemini model handles
+
+    genai.configure() and GenerativeModel construction are done once per
+    (model name, safety settings, system instruction) and reused across turns,
+    so the underlying client and its connections are shared instead of rebuilt.
+    '''
+
+    def __init__(self, max_size: int = 32):
+        self.max_size = max_size
+        self._models = OrderedDict()
+        self._api_key = None
+        self._lock = threading.Lock()
+
+    def configure(self, api_key: str):
+        '''Configure the client once; only reconfigure when the API key changes'''
+        with self._lock:
+            if api_key != self._api_key:
+                _genai().configure(api_key=api_key)
+                self._api_key = api_key
+                self._models.clear()
+
+    @staticmethod
+    def make_key(model_name: str, safety_settings=None, system_instruction: str = None) -> tuple:
+        '''Build the pool key; the system instruction is hashed to keep keys small'''
+        safety_key = tuple(
+            (setting['category'], setting['threshold']) for setting in safety_settings or []
+        )
+        instruction_key = None
+        if system_instruction:
+            instruction_key = hashlib.sha256(system_instruction.encode('utf-8')).hexdigest()
+        return (model_name, safety_key, instruction_key)
+
+    def get(self, model_name: str, safety_settings=None, system_instruction: str = None):
+        '''Return a pooled model handle, creating and evicting as needed'''
+        key = self.make_key(model_name, safety_settings, system_instruction)
+        with self._lock:
+            model = self._models.get(key)
+            if model is not None:
+                self._models.move_to_end(key)
+                return model
+
+            model = _genai().GenerativeModel(
+                model_name=model_name,
+                safety_settings=safety_settings,
+                system_instruction=system_instruction
+            )
+            self._models[key] = model
+            while len(self._models) > self.max_size:
+                self._models.popitem(last=False)
+            return model
+
+    def __len__(self):
+        return len(self._models)
+
+# Shared by every GoogleAI instance in the process
+model_pool = ModelPool()
+
 class GoogleAI(AIProvider):
     '''Google Generative AI implementation'''
 
-    def __init__(self, api_key: str, model_name: str = "gemini-pro"):
-        '''Initialize Google AI with API key and optional model name'''
-        genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel(model_name)
+    def __init__(self, api_key: str, model_name: str = "gemini-pro", safety_settings=None,
+                 pool: ModelPool = None):
+        '''Initialize Google AI with API key, optional model name and safety settings'''
+        self.model_name = model_name
+        self.safety_settings = safety_settings
+        self.pool = pool or model_pool
+        self.pool.configure(api_key)
 
-    def generate_content(self, prompt: str, max_tokens: int = 300, temperature: float = 1.0) -> str:
-        """Generate content using Google's generative AI"""
-        try:
-            response = self.model.generate_content(
-                prompt,
-                generation_config=genai.types.GenerationConfig(
-                    max_output_tokens=max_tokens,
-                    temperature=temperature
-                )
-            )
-            return response.text
-        except Exception as e:
-            print(f'Error generating content with Google AI: {e}')
-            return ''
+    def get_model(self, system_instruction: str = None):
+        '''Get a pooled model handle for the given system instruction'''
+        return self.pool.get(self.model_name, self.safety_settings, system_instruction)
+
+    @staticmethod
+    def generation_config(max_tokens: int, temperature: float):
+        return _genai().types.GenerationConfig(max_output_tokens=max_tokens, temperature=temperature)
+
+    def generate_content(self, prompt: str, max_tokens: int = 300, temperature: float = 1.0,
+                         system_instruction: str = None) -> str:
+        """Generate content using Google's generative AI; errors are left to AIService to retry or report"""
+        response = self.get_model(system_instruction).generate_content(
+            prompt,
+            generation_config=self.generation_config(max_tokens, temperature)
+        )
+        return response.text
+
+    def generate_content_stream(self, prompt: str, max_tokens: int = 300, temperature: float = 1.0,
+                                system_instruction: str = None) -> Iterator[str]:
+        """Stream content chunks from Google's generative AI as they are generated"""
+        response = self.get_model(system_instruction).generate_content(
+            prompt,
+            generation_config=self.generation_config(max_tokens, temperature),
+            stream=True
+        )
+        for chunk in response:
+            if chunk.text:
+                yield chunk.text
+
+    async def generate_content_async(self, prompt: str, max_tokens: int = 300, temperature: float = 1.0,
+                                     system_instruction: str = None) -> str:
+        """Generate content using Google's async client"""
+        response = await self.get_model(system_instruction).generate_content_async(
+            prompt,
+            generation_config=self.generation_config(max_tokens, temperature)
+        )
+        return response.text
+
+    def start_chat(self, system_instruction: str = None, history: list = None) -> ChatSession:
+        return GoogleChatSession(self, system_instruction, history)
+
+class GoogleChatSession(ChatSession):
+    '''Chat backed by the Gemini chat API'''
+
+    def __init__(self, provider: GoogleAI, system_instruction: str = None, history: list = None):
+        super().__init__(provider, system_instruction, history)
+        self.chat = provider.get_model(system_instruction).start_chat(history=[
+            { 'role': 'model' if turn['role'] == 'assistant' else 'user', 'parts': [turn['content']] }
+            for turn in self.history
+        ])
+
+    def send_message(self, message: str, max_tokens: int = 300, temperature: float = 1.0) -> str:
+        response = self.chat.send_message(
+            message,
+            generation_config=GoogleAI.generation_config(max_tokens, temperature)
+        )
+        self._record(message, response.text)
+        return response.text
+
+    def send_message_stream(self, message: str, max_tokens: int = 300, temperature: float = 1.0) -> Iterator[str]:
+        response = self.chat.send_message(
+            message,
+            generation_config=GoogleAI.generation_config(max_tokens, temperature),
+            stream=True
+        )
+        chunks = []
+        for chunk in response:
+            if chunk.text:
+                chunks.append(chunk.text)
+                yield chunk.text
+        self._record(message, ''.join(chunks))
+
+    async def send_message_async(self, message: str, max_tokens: int = 300, temperature: float = 1.0) -> str:
+        response = await self.chat.send_message_async(
+            message,
+            generation_config=GoogleAI.generation_config(max_tokens, temperature)
+        )
+        self._record(message, response.text)
+        return response.text
 
 class OpenAI(AIProvider):
     '''OpenAI implementation (placeholder)'''
@@ -40,37 +307,549 @@ class OpenAI(AIProvider):
         self.api_key = api_key
         self.model_name = model_name
         
-    def generate_content(self, prompt: str, max_tokens: int = 300, temperature: float = 1.0) -> str:
+    def generate_content(self, prompt: str, max_tokens: int = 300, temperature: float = 1.0,
+                         system_instruction: str = None) -> str:
         '''Generate content using OpenAI'''
         raise NotImplementedError('OpenAI provider is not yet implemented.')
 
-class AIProviderFactory:
+LOCAL_VOCABULARY = (
+    'the', 'a', 'old', 'road', 'village', 'forest', 'smoke', 'light', 'quietly', 'turns',
+    'looks', 'says', 'nods', 'toward', 'you', 'with', 'and', 'of', 'ash', 'blade',
+    'ruined', 'wind', 'slowly', 'listens', 'remembers', 'before', 'again', 'here', 'now', 'still'
+)
+
+class LocalAI(AIProvider):
+    '''
+    Deterministic offline provider for development and benchmarking
+
+    Responses are derived from a hash of the prompt and system instruction, so
+    the same input always gives the same output. Latency, streaming token rate
+    and failures can be injected to simulate a remote service.
+    '''
+
+    def __init__(self, model_name: str = 'local', latency: float = 0.0, token_rate: float = None,
+                 failure_rate: float = 0.0, response_words: int = 60, seed: int = 0):
+        '''
+        Args:
+            latency: Seconds to wait before the first token
+            token_rate: Streamed words per second (None streams without delay)
+            failure_rate: Probability in [0, 1] that a call fails
+            response_words: Upper bound on the number of words per response
+            seed: Seed for the failure injection
+        '''
+        self.model_name = model_name
+        self.latency = latency
+        self.token_rate = token_rate
+        self.failure_rate = failure_rate
+        self.response_words = response_words
+        self.requests = [] # (prompt chars, system instruction chars) for every call
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _respond(self, prompt: str, max_tokens: int, system_instruction: str) -> str:
+        '''Build the deterministic response text for a prompt'''
+        if BATCH_SECTION_PATTERN.match(prompt):
+            # Follow the micro-batch format like a real model would: one answer per section
+            sections = BATCH_SECTION_PATTERN.split(prompt)
+            return '\n'.join(
+                f'### {number}\n{self._respond(body.strip(), max_tokens, system_instruction)}'
+                for number, body in zip(sections[1::2], sections[2::2])
+            )
+        digest = hashlib.sha256(f'{system_instruction}\x00{prompt}'.encode('utf-8')).digest()
+        words = random.Random(digest)
+        count = min(max_tokens, self.response_words)
+        return ' '.join(words.choice(LOCAL_VOCABULARY) for _ in range(count))
+
+    def _begin(self, prompt: str, system_instruction: str) -> bool:
+        '''Record the request and decide whether it fails'''
+        with self._lock:
+            self.requests.append((len(prompt), len(system_instruction or '')))
+            return self._random.random() < self.failure_rate
+
+    def generate_content(self, prompt: str, max_tokens: int = 300, temperature: float = 1.0,
+                         system_instruction: str = None) -> str:
+        failed = self._begin(prompt, system_instruction)
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            raise ProviderError('Injected failure from local AI', retriable=True)
+        text = self._respond(prompt, max_tokens, system_instruction)
+        if self.token_rate:
+            time.sleep(len(text.split()) / self.token_rate)
+        return text
+
+    def generate_content_stream(self, prompt: str, max_tokens: int = 300, temperature: float = 1.0,
+                                system_instruction: str = None) -> Iterator[str]:
+        failed = self._begin(prompt, system_instruction)
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            raise ProviderError('Injected failure from local AI', retriable=True)
+        for index, word in enumerate(self._respond(prompt, max_tokens, system_instruction).split(' ')):
+            if self.token_rate:
+                time.sleep(1 / self.token_rate)
+            yield word if index == 0 else f' {word}'
+
+    async def generate_content_async(self, prompt: str, max_tokens: int = 300, temperature: float = 1.0,
+                                     system_instruction: str = None) -> str:
+        failed = self._begin(prompt, system_instruction)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if failed:
+            raise ProviderError('Injected failure from local AI', retriable=True)
+        text = self._respond(prompt, max_tokens, system_instruction)
+        if self.token_rate:
+            await asyncio.sleep(len(text.split()) / self.token_rate)
+        return text
+
+class ReplayAI(LocalAI):
+    '''
+    Offline provider that replays recorded responses
+
+    The recording is a JSON list of {"prompt", "system_instruction", "response"}
+    objects. Prompts that were not recorded fall back to LocalAI's deterministic text.
+    '''
+
+    def __init__(self, recording_path: str, model_name: str = 'replay', **kwargs):
+        super().__init__(model_name=model_name, **kwargs)
+        self.recording_path = recording_path
+        self.recordings = {}
+        try:
+            with open(recording_path, 'r') as f:
+                for entry in json.load(f):
+                    self.record(entry.get('prompt', ''), entry.get('system_instruction'), entry['response'])
+        except FileNotFoundError:
+            print(f"Replay file '{recording_path}' not found, using generated responses.")
+
     @staticmethod
-    def create_provider(provider_type: str, config: dict) -> AIProvider:
+    def _key(prompt: str, system_instruction: str) -> str:
+        return hashlib.sha256(f'{system_instruction}\x00{prompt}'.encode('utf-8')).hexdigest()
+
+    def record(self, prompt: str, system_instruction: str, response: str):
+        '''Add a recorded response'''
+        self.recordings[self._key(prompt, system_instruction)] = {
+            'prompt': prompt,
+            'system_instruction': system_instruction,
+            'response': response
+        }
+
+    def save(self, recording_path: str = None):
+        '''Write the recordings back to disk'''
+        with open(recording_path or self.recording_path, 'w') as f:
+            json.dump(list(self.recordings.values()), f, indent=2)
+
+    def _respond(self, prompt: str, max_tokens: int, system_instruction: str) -> str:
+        recorded = self.recordings.get(self._key(prompt, system_instruction))
+        if recorded is not None:
+            return recorded['response']
+        return super()._respond(prompt, max_tokens, system_instruction)
+
+# Entry point group searched for provider plugins, e.g. in a plugin's pyproject.toml:
+#   [project.entry-points."ai_text_adventure.providers"]
+#   anthropic = "my_plugin:create_provider"
+PROVIDER_ENTRY_POINT_GROUP = 'ai_text_adventure.providers'
+
+class AIProviderFactory:
+    '''
+    Registry of AI providers by name
+
+    Each name maps to a builder taking the config dict and returning an
+    AIProvider. The built-in providers are registered below; others are
+    discovered from the PROVIDER_ENTRY_POINT_GROUP entry points the first
+    time an unknown name is asked for, so installing a plugin package is
+    enough to make a new AI_PROVIDER value work. Builders import their SDKs
+    when called, so only the provider in use is ever imported.
+    '''
+    _builders = {} # name -> builder
+    _entry_points = None # name -> importlib.metadata.EntryPoint, not loaded yet
+    _lock = threading.Lock()
+
+    @classmethod
+    def register(cls, name: str, builder=None):
+        '''Register builder under name; usable as a decorator when builder is omitted'''
+        def decorate(builder):
+            with cls._lock:
+                cls._builders[name.lower()] = builder
+            return builder
+        return decorate(builder) if builder is not None else decorate
+
+    @classmethod
+    def _discover(cls) -> dict:
+        # Scanning installed packages is slow, so it waits until a name is not registered
+        import importlib.metadata
+        with cls._lock:
+            if cls._entry_points is None:
+                cls._entry_points = {
+                    entry_point.name.lower(): entry_point
+                    for entry_point in importlib.metadata.entry_points(group=PROVIDER_ENTRY_POINT_GROUP)
+                }
+            return cls._entry_points
+
+    @classmethod
+    def available(cls) -> list:
+        '''Names of the registered and installed providers, without loading any'''
+        return sorted(set(cls._builders) | set(cls._discover()))
+
+    @classmethod
+    def create_provider(cls, provider_type: str, config: dict) -> AIProvider:
         '''
         Create an AI provider based on the provider type string from config
         
         Args:
-            provider_type: String identifier for the provider (e.g., 'google', 'openai')
+            provider_type: String identifier for the provider (e.g., 'google', 'openai', 'local', 'replay')
             config: Dictionary containing provider-specific configuration
         
         Returns:
             An instance of the specified AI provider
         '''
         provider_type = provider_type.lower()
-        
-        if provider_type == 'google':
-            return GoogleAI(
-                api_key=config.get('api_key'),
-                model_name=config.get('model_name', 'gemini-pro')
-            )
-        elif provider_type == 'openai':
-            return OpenAI(
-                api_key=config.get('api_key'),
-                model_name=config.get('model_name', 'gpt-3.5-turbo')
+        builder = cls._builders.get(provider_type)
+        if builder is None:
+            entry_point = cls._discover().get(provider_type)
+            if entry_point is None:
+                raise ValueError(f"Unknown AI provider type: {provider_type} (available: {', '.join(cls.available())})")
+            builder = cls.register(provider_type, entry_point.load())
+        return builder(config)
+
+@AIProviderFactory.register('google')
+def _create_google(config: dict) -> AIProvider:
+    return GoogleAI(
+        api_key=config.get('api_key'),
+        model_name=config.get('model_name') or 'gemini-pro',
+        safety_settings=config.get('safety_settings')
+    )
+
+@AIProviderFactory.register('openai')
+def _create_openai(config: dict) -> AIProvider:
+    return OpenAI(
+        api_key=config.get('api_key'),
+        model_name=config.get('model_name', 'gpt-3.5-turbo')
+    )
+
+@AIProviderFactory.register('local')
+def _create_local(config: dict) -> AIProvider:
+    return LocalAI(
+        model_name=config.get('model_name') or 'local',
+        latency=float(config.get('latency', 0.0)),
+        token_rate=config.get('token_rate'),
+        failure_rate=float(config.get('failure_rate', 0.0)),
+        seed=int(config.get('seed', 0))
+    )
+
+@AIProviderFactory.register('replay')
+def _create_replay(config: dict) -> AIProvider:
+    return ReplayAI(
+        recording_path=config.get('recording_path', 'replay.json'),
+        latency=float(config.get('latency', 0.0)),
+        token_rate=config.get('token_rate'),
+        failure_rate=float(config.get('failure_rate', 0.0)),
+        seed=int(config.get('seed', 0))
+    )
+
+BATCH_INSTRUCTIONS = '''
+You will receive {count} independent inputs, each starting with a line "### <number>".
+Apply the instructions above to each input separately.
+Answer with exactly {count} sections in the same order, each starting with its "### <number>" line.
+'''
+
+BATCH_SECTION_PATTERN = re.compile(r'^###\s*(\d+)\s*$', re.MULTILINE)
+
+class TokenBucket:
+    '''Allows rate requests per second on average, with bursts of up to capacity'''
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        '''Seconds until a whole token is available'''
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+class RequestScheduler:
+    '''
+    Rate limiting, prioritization and retries for provider calls
+
+    Each (provider, model) key gets a token bucket of requests_per_minute
+    (unlimited when None). Callers waiting for a token queue by Priority, so
+    dialogue goes ahead of background summaries and prefetches. Calls failing
+    with a retriable error are retried up to max_retries times with
+    exponential backoff and full jitter; a rate limit reported by the provider
+    also empties the bucket so other callers back off too.
+
+    A deadline (time.monotonic() value) bounds waiting and retrying. Async
+    calls are also cancelled at the deadline; a blocking call in progress
+    cannot be interrupted.
+    '''
+
+    # How often queued callers check whether it is their turn
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, requests_per_minute: float = None, burst: int = None, max_retries: int = 3,
+                 base_delay: float = 0.5, max_delay: float = 20.0, seed: int = None):
+        self.requests_per_minute = requests_per_minute
+        self.burst = burst or max(1, int((requests_per_minute or 0) / 6))
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retries = 0
+        self.throttled = 0
+        self._buckets = {} # key -> TokenBucket
+        self._waiting = {} # key -> heap of (priority, ticket)
+        self._tickets = itertools.count()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _bucket(self, key) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.requests_per_minute / 60, self.burst)
+            self._buckets[key] = bucket
+        return bucket
+
+    def _enqueue(self, key, priority: Priority):
+        entry = (int(priority), next(self._tickets))
+        with self._lock:
+            heapq.heappush(self._waiting.setdefault(key, []), entry)
+        return entry
+
+    def _try_acquire(self, key, entry, deadline: float):
+        '''Take a token if entry is first in line; otherwise return how long to wait'''
+        now = time.monotonic()
+        with self._lock:
+            queue = self._waiting[key]
+            bucket = self._bucket(key)
+            bucket.refill(now)
+            if queue[0] == entry and bucket.tokens >= 1:
+                bucket.tokens -= 1
+                heapq.heappop(queue)
+                return None
+            wait = bucket.wait_time() if queue[0] == entry else self.POLL_INTERVAL
+            wait = max(min(wait, self.POLL_INTERVAL), 0.001)
+            if deadline is not None and now + wait > deadline:
+                queue.remove(entry)
+                heapq.heapify(queue)
+                raise DeadlineExceeded('Deadline passed while waiting for the rate limit')
+            return wait
+
+    def acquire(self, key, priority: Priority = Priority.INTERACTIVE, deadline: float = None):
+        '''Block until a request for key may be sent'''
+        if self.requests_per_minute is None:
+            return
+        entry = self._enqueue(key, priority)
+        try:
+            wait = self._try_acquire(key, entry, deadline)
+            if wait is not None:
+                self.throttled += 1
+                metrics.increment('provider_throttled', provider=key[0], priority=priority.name)
+            while wait is not None:
+                time.sleep(wait)
+                wait = self._try_acquire(key, entry, deadline)
+        except BaseException:
+            # e.g. KeyboardInterrupt while sleeping; a stale entry at the head would stall the queue
+            self._dequeue(key, entry)
+            raise
+
+    async def acquire_async(self, key, priority: Priority = Priority.INTERACTIVE, deadline: float = None):
+        if self.requests_per_minute is None:
+            return
+        entry = self._enqueue(key, priority)
+        try:
+            wait = self._try_acquire(key, entry, deadline)
+            if wait is not None:
+                self.throttled += 1
+                metrics.increment('provider_throttled', provider=key[0], priority=priority.name)
+            while wait is not None:
+                await asyncio.sleep(wait)
+                wait = self._try_acquire(key, entry, deadline)
+        except BaseException:
+            self._dequeue(key, entry)
+            raise
+
+    def _dequeue(self, key, entry):
+        '''Give up a place in the queue, if it is still held'''
+        with self._lock:
+            queue = self._waiting[key]
+            if entry in queue:
+                queue.remove(entry)
+                heapq.heapify(queue)
+
+    def _backoff(self, key, attempt: int, error: BaseException, deadline: float) -> float:
+        '''Delay before retry number attempt + 1; re-raises error when it should not be retried'''
+        if attempt >= self.max_retries or not is_retriable(error):
+            raise error
+        if is_rate_limited(error) and self.requests_per_minute is not None:
+            with self._lock:
+                bucket = self._bucket(key)
+                bucket.tokens = min(bucket.tokens, 0)
+        delay = self._random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if deadline is not None and time.monotonic() + delay > deadline:
+            raise error
+        self.retries += 1
+        metrics.increment('provider_retries', provider=key[0])
+        return delay
+
+    def call(self, key, fn, priority: Priority = Priority.INTERACTIVE, deadline: float = None):
+        '''Call fn() once allowed, retrying retriable failures'''
+        for attempt in itertools.count():
+            self.acquire(key, priority, deadline)
+            try:
+                return fn()
+            except Exception as e:
+                time.sleep(self._backoff(key, attempt, e, deadline))
+
+    async def call_async(self, key, fn, priority: Priority = Priority.INTERACTIVE, deadline: float = None):
+        '''Await fn() once allowed, retrying retriable failures'''
+        for attempt in itertools.count():
+            await self.acquire_async(key, priority, deadline)
+            try:
+                if deadline is None:
+                    return await fn()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DeadlineExceeded('Deadline passed before the call was sent')
+                try:
+                    return await asyncio.wait_for(fn(), remaining)
+                except asyncio.TimeoutError:
+                    raise DeadlineExceeded('Deadline passed while waiting for the reply') from None
+            except Exception as e:
+                await asyncio.sleep(self._backoff(key, attempt, e, deadline))
+
+    def stream(self, key, fn, priority: Priority = Priority.INTERACTIVE, deadline: float = None) -> Iterator[str]:
+        '''
+        Yield from fn() once allowed. A failure is only retried while nothing
+        has been yielded, so the consumer never sees text repeated.
+        '''
+        for attempt in itertools.count():
+            self.acquire(key, priority, deadline)
+            started = False
+            try:
+                for chunk in fn():
+                    started = True
+                    yield chunk
+                return
+            except Exception as e:
+                if started:
+                    raise
+                time.sleep(self._backoff(key, attempt, e, deadline))
+
+class ScheduledChatSession:
+    '''A provider chat session whose messages go through a RequestScheduler'''
+
+    def __init__(self, session: ChatSession, service: 'AIService', priority: Priority = Priority.INTERACTIVE):
+        self.session = session
+        self.service = service
+        self.priority = priority
+
+    @property
+    def history(self):
+        return self.session.history
+
+    def send_message(self, message: str, max_tokens: int = 300, temperature: float = 1.0) -> str:
+        return self.service._call(
+            lambda: self.session.send_message(message, max_tokens, temperature), self.priority, prompt=message
+        )
+
+    def send_message_stream(self, message: str, max_tokens: int = 300, temperature: float = 1.0) -> Iterator[str]:
+        return self.service._stream(
+            lambda: self.session.send_message_stream(message, max_tokens, temperature), self.priority, prompt=message
+        )
+
+    async def send_message_async(self, message: str, max_tokens: int = 300, temperature: float = 1.0) -> str:
+        return await self.service._call_async(
+            lambda: self.session.send_message_async(message, max_tokens, temperature), self.priority, prompt=message
+        )
+
+class MicroBatcher:
+    '''
+    Groups low-priority requests that arrive within a short window into one model call
+
+    Requests are grouped by (system instruction, temperature, priority). A batch is sent
+    once the window closes or it reaches max_batch_size requests. Identical
+    prompts in a batch share one slot. If the reply cannot be split back into
+    one answer per input, each request is retried on its own.
+
+    Bound to the event loop it was created on.
+    '''
+
+    def __init__(self, generate, window: float = 0.05, max_batch_size: int = 8):
+        '''generate is a coroutine function taking (prompt, max_tokens, temperature, system_instruction, priority)'''
+        self.generate = generate
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._batches = {} # (system instruction, temperature, priority) -> [(prompt, max_tokens, future)]
+        self._timers = {}
+
+    async def submit(self, prompt: str, max_tokens: int = 300, temperature: float = 1.0,
+                     system_instruction: str = None, priority: Priority = Priority.BACKGROUND) -> str:
+        loop = asyncio.get_running_loop()
+        group = (system_instruction, temperature, priority)
+        future = loop.create_future()
+        batch = self._batches.setdefault(group, [])
+        batch.append((prompt, max_tokens, future))
+        if len(batch) >= self.max_batch_size:
+            self._flush(group)
+        elif group not in self._timers:
+            self._timers[group] = loop.call_later(self.window, self._flush, group)
+        return await future
+
+    def _flush(self, group):
+        timer = self._timers.pop(group, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._batches.pop(group, None)
+        if batch:
+            asyncio.ensure_future(self._send(group, batch))
+
+    async def _send(self, group, batch):
+        system_instruction, temperature, priority = group
+        prompts = list(dict.fromkeys(prompt for prompt, _, _ in batch))
+        try:
+            if len(prompts) == 1:
+                answers = { prompts[0]: await self.generate(
+                    prompts[0], max(max_tokens for _, max_tokens, _ in batch), temperature, system_instruction, priority
+                ) }
+            else:
+                answers = await self._send_combined(prompts, batch, system_instruction, temperature, priority)
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for prompt, _, future in batch:
+            if not future.done():
+                future.set_result(answers.get(prompt, ''))
+
+    async def _send_combined(self, prompts, batch, system_instruction, temperature, priority):
+        combined_prompt = '\n\n'.join(f'### {number}\n{prompt}' for number, prompt in enumerate(prompts, 1))
+        combined_instruction = (system_instruction or '') + BATCH_INSTRUCTIONS.format(count=len(prompts))
+        max_tokens = min(8192, sum(max_tokens for _, max_tokens, _ in batch))
+        text = await self.generate(combined_prompt, max_tokens, temperature, combined_instruction, priority)
+
+        sections = BATCH_SECTION_PATTERN.split(text or '')
+        # split() gives [preamble, number, body, number, body, ...]
+        answers = {}
+        for number, body in zip(sections[1::2], sections[2::2]):
+            index = int(number) - 1
+            if 0 <= index < len(prompts) and body.strip():
+                answers[prompts[index]] = body.strip()
+        if len(answers) == len(prompts):
+            return answers
+
+        # Malformed reply: fall back to one call per prompt
+        replies = await asyncio.gather(*[
+            self.generate(
+                prompt, max(max_tokens for p, max_tokens, _ in batch if p == prompt), temperature, system_instruction,
+                priority
             )
-        else:
-            raise ValueError(f'Unknown AI provider type: {provider_type}')
+            for prompt in prompts
+        ])
+        return dict(zip(prompts, replies))
 
 class AIService:
     @classmethod
@@ -84,7 +863,10 @@ class AIService:
             {
                 'provider': 'google',
                 'api_key': 'your-api-key',
-                'model_name': 'gemini-pro'
+                'model_name': 'gemini-pro',
+                'cache': ResponseCache(disk_path='.cache/responses.sqlite3'),  # optional
+                'requests_per_minute': 60,  # optional, unlimited by default
+                'max_retries': 3  # optional
             }
         '''
         provider_type = config.get('provider')
@@ -92,13 +874,273 @@ class AIService:
             raise ValueError('Provider type must be specified in config')
             
         provider = AIProviderFactory.create_provider(provider_type, config)
-        return cls(provider)
+        requests_per_minute = config.get('requests_per_minute')
+        return cls(
+            provider,
+            cache=config.get('cache'),
+            batch_window=float(config.get('batch_window', 0.05)),
+            max_batch_size=int(config.get('max_batch_size', 8)),
+            scheduler=RequestScheduler(
+                requests_per_minute=float(requests_per_minute) if requests_per_minute else None,
+                max_retries=int(config.get('max_retries', 3))
+            )
+        )
     
-    def __init__(self, provider: AIProvider):
+    def __init__(self, provider: AIProvider, cache: ResponseCache = None, batch_window: float = 0.05,
+                 max_batch_size: int = 8, scheduler: RequestScheduler = None):
         self.provider = provider
+        self.cache = cache
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.scheduler = scheduler or RequestScheduler()
+        self._in_flight = {} # cache key -> Future shared by every caller waiting on that request
+        self._in_flight_lock = threading.Lock()
+        self._batchers = weakref.WeakKeyDictionary() # event loop -> MicroBatcher
+
+    def _schedule_key(self):
+        return (type(self.provider).__name__, getattr(self.provider, 'model_name', None))
+
+    @staticmethod
+    def _deadline(timeout: float):
+        return time.monotonic() + timeout if timeout is not None else None
+
+    def _provider_label(self):
+        return type(self.provider).__name__
+
+    def _call(self, fn, priority: Priority = Priority.INTERACTIVE, timeout: float = None, prompt: str = '') -> str:
+        '''Run a provider call through the scheduler; after the last retry the error is printed and '' returned'''
+        try:
+            text = self.scheduler.call(self._schedule_key(), fn, priority, self._deadline(timeout))
+        except Exception as e:
+            print(f'Error generating content: {e}')
+            metrics.increment('provider_errors', provider=self._provider_label())
+            return ''
+        metrics.record_tokens(prompt, text, provider=self._provider_label())
+        return text
+
+    async def _call_async(self, fn, priority: Priority = Priority.INTERACTIVE, timeout: float = None,
+                          prompt: str = '') -> str:
+        try:
+            text = await self.scheduler.call_async(self._schedule_key(), fn, priority, self._deadline(timeout))
+        except Exception as e:
+            print(f'Error generating content: {e}')
+            metrics.increment('provider_errors', provider=self._provider_label())
+            return ''
+        metrics.record_tokens(prompt, text, provider=self._provider_label())
+        return text
+
+    def _stream(self, fn, priority: Priority = Priority.INTERACTIVE, timeout: float = None,
+                prompt: str = '') -> Iterator[str]:
+        '''Like _call for streams; a stream failing part way just ends early'''
+        chunks = []
+        try:
+            for chunk in self.scheduler.stream(self._schedule_key(), fn, priority, self._deadline(timeout)):
+                chunks.append(chunk)
+                yield chunk
+        except Exception as e:
+            print(f'Error streaming content: {e}')
+            metrics.increment('provider_errors', provider=self._provider_label())
+        metrics.record_tokens(prompt, ''.join(chunks), provider=self._provider_label())
+
+    async def _generate_for_batch(self, prompt: str, max_tokens: int, temperature: float,
+                                  system_instruction: str, priority: Priority) -> str:
+        # Errors propagate so MicroBatcher can fail the whole batch instead of splitting an empty reply
+        text = await self.scheduler.call_async(
+            self._schedule_key(),
+            lambda: self.provider.generate_content_async(prompt, max_tokens, temperature, system_instruction),
+            priority
+        )
+        # Tokens are counted per request by generate_content_batched, which runs in its caller's context
+        return text
+
+    def _cache_key(self, prompt: str, max_tokens: int, temperature: float, system_instruction: str):
+        return ResponseCache.make_key(
+            type(self.provider).__name__,
+            getattr(self.provider, 'model_name', None),
+            prompt,
+            system_instruction,
+            max_tokens,
+            temperature
+        )
+
+    def _cached(self, key: str):
+        if self.cache is None:
+            return None
+        text = self.cache.get(key)
+        metrics.increment('cache_lookups', result='miss' if text is None else 'hit', **metrics.caller_labels())
+        return text
+
+    def _join_flight(self, key: str):
+        '''
+        Single-flight: returns (future, is_leader). Only the leader calls the
+        provider; everyone else asking for the same key waits on its future.
+        '''
+        with self._in_flight_lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                return future, False
+            future = concurrent.futures.Future()
+            self._in_flight[key] = future
+            return future, True
+
+    def _land_flight(self, key: str, future, text: str = None, error: BaseException = None, store: bool = True):
+        if text and store and self.cache is not None:
+            self.cache.set(key, text)
+        with self._in_flight_lock:
+            self._in_flight.pop(key, None)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(text)
     
-    def generate_content(self, prompt: str, max_tokens: int = 300, temperature: float = 1.0) -> str:
-        return self.provider.generate_content(prompt, max_tokens, temperature)
+    @metrics.timed('ai.generate_content', attribute=False)
+    def generate_content(self, prompt: str, max_tokens: int = 300, temperature: float = 1.0,
+                         system_instruction: str = None, use_cache: bool = True,
+                         priority: Priority = Priority.INTERACTIVE, timeout: float = None) -> str:
+        '''
+        Generate content. Unless use_cache is False, repeated prompts are served
+        from the cache and identical requests already in flight are shared.
+
+        Calls are rate limited and retried by the scheduler according to
+        priority; timeout bounds the time spent waiting and retrying. Returns
+        '' when the call still fails.
+        '''
+        call = lambda: self.provider.generate_content(prompt, max_tokens, temperature, system_instruction)
+        if not use_cache:
+            return self._call(call, priority, timeout, prompt)
+
+        key = self._cache_key(prompt, max_tokens, temperature, system_instruction)
+        while True:
+            text = self._cached(key)
+            if text is not None:
+                return text
+            future, is_leader = self._join_flight(key)
+            if is_leader:
+                break
+            try:
+                return future.result()
+            except FlightAbandoned:
+                continue
+        try:
+            text = self._call(call, priority, timeout, prompt)
+        except BaseException:
+            # Only interruptions get here (_call reports errors itself); waiting callers make the request themselves
+            self._land_flight(key, future, error=FlightAbandoned())
+            raise
+        self._land_flight(key, future, text)
+        return text
+
+    @metrics.timed('ai.generate_content_stream', attribute=False)
+    def generate_content_stream(self, prompt: str, max_tokens: int = 300, temperature: float = 1.0,
+                                system_instruction: str = None, use_cache: bool = True,
+                                priority: Priority = Priority.INTERACTIVE, timeout: float = None) -> Iterator[str]:
+        '''Stream content; a cache hit or a shared in-flight request is yielded as a single chunk'''
+        call = lambda: self.provider.generate_content_stream(prompt, max_tokens, temperature, system_instruction)
+        if not use_cache:
+            yield from self._stream(call, priority, timeout, prompt)
+            return
+
+        key = self._cache_key(prompt, max_tokens, temperature, system_instruction)
+        while True:
+            text = self._cached(key)
+            if text is None:
+                future, is_leader = self._join_flight(key)
+                if not is_leader:
+                    try:
+                        text = future.result()
+                    except FlightAbandoned:
+                        continue
+            break
+        if text is not None:
+            if text:
+                yield text
+            return
+
+        chunks = []
+        completed = False
+        try:
+            for chunk in self.scheduler.stream(self._schedule_key(), call, priority, self._deadline(timeout)):
+                chunks.append(chunk)
+                yield chunk
+            completed = True
+        except Exception as e:
+            print(f'Error streaming content: {e}')
+            metrics.increment('provider_errors', provider=self._provider_label())
+        finally:
+            metrics.record_tokens(prompt, ''.join(chunks), provider=self._provider_label())
+            if not future.done():
+                # A failed or abandoned stream: followers get what was streamed, but it is not cached
+                self._land_flight(key, future, ''.join(chunks), store=completed)
+
+    @metrics.timed('ai.generate_content_async', attribute=False)
+    async def generate_content_async(self, prompt: str, max_tokens: int = 300, temperature: float = 1.0,
+                                     system_instruction: str = None, use_cache: bool = True,
+                                     priority: Priority = Priority.INTERACTIVE, timeout: float = None) -> str:
+        call = lambda: self.provider.generate_content_async(prompt, max_tokens, temperature, system_instruction)
+        if not use_cache:
+            return await self._call_async(call, priority, timeout, prompt)
+
+        key = self._cache_key(prompt, max_tokens, temperature, system_instruction)
+        while True:
+            text = self._cached(key)
+            if text is not None:
+                return text
+            future, is_leader = self._join_flight(key)
+            if is_leader:
+                break
+            try:
+                return await asyncio.wrap_future(future)
+            except FlightAbandoned:
+                continue
+        try:
+            text = await self._call_async(call, priority, timeout, prompt)
+        except BaseException:
+            # Cancelled, e.g. a prefetch that is no longer needed: waiting callers make the request themselves
+            self._land_flight(key, future, error=FlightAbandoned())
+            raise
+        self._land_flight(key, future, text)
+        return text
+
+    @metrics.timed('ai.generate_content_batched', attribute=False)
+    async def generate_content_batched(self, prompt: str, max_tokens: int = 300, temperature: float = 1.0,
+                                       system_instruction: str = None, use_cache: bool = True,
+                                       priority: Priority = Priority.BACKGROUND) -> str:
+        '''
+        Generate content for low-priority work (e.g. summaries) that can wait a
+        few milliseconds to be batched with similar requests into one call.
+        '''
+        key = self._cache_key(prompt, max_tokens, temperature, system_instruction)
+        if use_cache:
+            text = self._cached(key)
+            if text is not None:
+                return text
+
+        loop = asyncio.get_running_loop()
+        batcher = self._batchers.get(loop)
+        if batcher is None:
+            batcher = MicroBatcher(self._generate_for_batch, self.batch_window, self.max_batch_size)
+            self._batchers[loop] = batcher
+        try:
+            text = await batcher.submit(prompt, max_tokens, temperature, system_instruction, priority)
+        except Exception as e:
+            print(f'Error generating content: {e}')
+            return ''
+        metrics.record_tokens(prompt, text, provider=self._provider_label())
+        if text and use_cache and self.cache is not None:
+            self.cache.set(key, text)
+        return text
+    
+    def is_cached(self, prompt: str, max_tokens: int = 300, temperature: float = 1.0,
+                  system_instruction: str = None) -> bool:
+        '''Whether generate_content would be served from the cache'''
+        if self.cache is None:
+            return False
+        return self.cache.get(self._cache_key(prompt, max_tokens, temperature, system_instruction)) is not None
+
+    def start_chat(self, system_instruction: str = None, history: list = None,
+                   priority: Priority = Priority.INTERACTIVE) -> ScheduledChatSession:
+        '''Start a multi-turn chat; chat messages are scheduled but never cached'''
+        return ScheduledChatSession(self.provider.start_chat(system_instruction, history), self, priority)
     
     def switch_provider(self, new_provider: AIProvider):
         self.provider = new_provider
@@ -0,0 +1,68 @@
+import asyncio
+import concurrent.futures
+import threading
+
+class BackgroundRunner:
+    '''
+    Runs coroutines on an asyncio event loop living in a daemon thread
+
+    Used for work the player does not have to wait for, like summarizing an
+    interaction into memory. Call wait_all() before anything that depends on
+    the results (e.g. saving the game).
+    '''
+
+    def __init__(self):
+        self._loop = None
+        self._thread = None
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        '''Start the event loop thread on first use'''
+        if self._loop is not None:
+            return
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='background-runner', daemon=True)
+        self._thread.start()
+
+    def submit(self, coro) -> concurrent.futures.Future:
+        '''Schedule a coroutine and return a future for its result'''
+        with self._lock:
+            self._ensure_started()
+            future = asyncio.run_coroutine_threadsafe(coro, self._loop)
+            self._pending.add(future)
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _on_done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            print(f'Error in background task: {future.exception()}')
+
+    def pending(self) -> int:
+        '''Number of tasks that have not finished yet'''
+        with self._lock:
+            return len(self._pending)
+
+    def wait_all(self, timeout: float = None):
+        '''Block until every task submitted so far has finished'''
+        with self._lock:
+            pending = list(self._pending)
+        if pending:
+            concurrent.futures.wait(pending, timeout=timeout)
+
+    def shutdown(self, timeout: float = None):
+        '''Wait for outstanding tasks and stop the event loop'''
+        self.wait_all(timeout)
+        with self._lock:
+            if self._loop is None:
+                return
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout)
+            self._loop.close()
+            self._loop = None
+            self._thread = None
+
+# Shared runner for the game loop
+background_runner = BackgroundRunner()
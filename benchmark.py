@@ -0,0 +1,291 @@
+'''
+Offline latency benchmark for the game engine.
+
+Drives scripted sessions through handle_player_action and
+handle_character_interaction against the local provider, so no API key or
+network is needed. Usage:
+
+    python benchmark.py --sessions 20 --latency 0.05 --token-rate 200
+    python benchmark.py --startup 10
+'''
+import argparse
+import builtins
+import contextlib
+import io
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from ai_service import AIService
+from background import background_runner
+from entity_store import EntityStore
+from main import handle_player_action
+from metrics import metrics
+from narrator import Narrator
+from prefetch import Prefetcher
+from response_cache import ResponseCache
+from simulation import WorldSimulation
+from world import build_world, load_world
+
+DEFAULT_WORLD_FILENAME = 'game_setting.yaml.sample'
+FIRST_PROMPT = b"Enter your character's name"
+IMPORT_PROBE = 'import time; started = time.perf_counter(); import main; print(time.perf_counter() - started)'
+
+# Each entry is one line of player input; lines after 'interact' go to the character until 'back'
+DEFAULT_SCRIPT = [
+    'look',
+    'interact charlie',
+    'Hello, old friend.',
+    'What happened to the village?',
+    'Will you come with me to the forest?',
+    'back',
+    'invite charlie',
+    'move forest',
+    'look',
+    'move village',
+    'dismiss charlie',
+    'interact charlie',
+    'Do you remember what we talked about?',
+    'back',
+]
+
+def percentile(values, fraction):
+    '''Nearest-rank percentile of a list of numbers'''
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+def run_session(game_data, ai_service, player_name, script, store=None, live_narration=False, prefetch_budget=0,
+                think_time=0.0):
+    '''
+    Play one scripted session and return the latency of every turn in seconds.
+
+    A turn is the time between two consecutive reads of player input, which
+    covers both top-level commands and dialogue lines inside an interaction.
+    think_time is slept before each line is entered and is not counted.
+    '''
+    locations, characters, world_index = build_world(game_data, ai_service, store)
+    player = characters[player_name]
+    narrator = Narrator(ai_service) if live_narration else None
+    prefetcher = None
+    if live_narration and prefetch_budget > 0:
+        prefetcher = Prefetcher(ai_service, narrator, characters, locations, world_index, prefetch_budget)
+        prefetcher.schedule(player)
+    lines = iter(script)
+    turn_latencies = []
+    last_input = None
+
+    def scripted_input(prompt=''):
+        nonlocal last_input
+        now = time.perf_counter()
+        if last_input is not None:
+            turn_latencies.append(now - last_input)
+        if think_time:
+            time.sleep(think_time)
+        last_input = time.perf_counter()
+        return next(lines)
+
+    real_input = builtins.input
+    builtins.input = scripted_input
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            while True:
+                try:
+                    action = scripted_input()
+                except StopIteration:
+                    break
+                handle_player_action(player, characters, locations, action, world_index, narrator, live_narration)
+                if prefetcher is not None:
+                    prefetcher.schedule(player)
+            # The final turn ends when the script runs out
+            if last_input is not None:
+                turn_latencies.append(time.perf_counter() - last_input)
+    finally:
+        builtins.input = real_input
+        if prefetcher is not None:
+            prefetcher.cancel()
+    return turn_latencies
+
+def synthetic_world(population, characters_per_location=50):
+    '''Setting data for a generated world: a ring of locations with a few shortcuts, evenly populated'''
+    location_count = max(2, population // characters_per_location)
+    locations = {
+        f'Place {index}': {
+            'description': f'Generated place number {index}.',
+            'connections': sorted({
+                f'Place {(index + 1) % location_count}',
+                f'Place {(index - 1) % location_count}',
+                f'Place {(index * 7) % location_count}'
+            } - {f'Place {index}'})
+        }
+        for index in range(location_count)
+    }
+    characters = {
+        f'Npc {index}': {
+            'age': 20 + index % 50,
+            'relationships': [],
+            'personality': 'A generated character.',
+            'backstory': 'Lives in a generated world.',
+            'location': f'Place {index % location_count}'
+        }
+        for index in range(population)
+    }
+    return { 'world_description': 'A generated world.', 'locations': locations, 'characters': characters }
+
+def benchmark_ticks(populations, ticks, ai_service, workers):
+    '''Time simulation ticks for worlds of each population size'''
+    print(f'Simulation ticks ({ticks} per population, {workers} workers):')
+    for population in populations:
+        game_data = synthetic_world(population)
+        locations, characters, world_index = build_world(game_data, ai_service)
+        simulation = WorldSimulation(characters, world_index, ai_service, player=characters['Npc 0'], workers=workers,
+                                     seed=0)
+        simulation.tick() # Builds the characters
+        rule_seconds = []
+        model_seconds = []
+        moves = 0
+        for _ in range(ticks):
+            report = simulation.tick()
+            rule_seconds.append(report.rule_seconds)
+            model_seconds.append(report.model_seconds)
+            moves += report.moves
+        simulation.shutdown()
+        average = sum(rule_seconds) / len(rule_seconds)
+        print(f'  {population:>7} NPCs: rules p50={percentile(rule_seconds, 0.5) * 1000:.2f} ms, '
+              f'{average / population * 1e6:.2f} us/NPC, model max={max(model_seconds) * 1000:.2f} ms, '
+              f'{moves / ticks:.0f} moves/tick')
+
+def time_to_first_prompt(world_filename, env):
+    '''Seconds from starting main.py in a fresh directory until it asks for the player's name'''
+    directory = tempfile.mkdtemp(prefix='startup-')
+    try:
+        shutil.copy(world_filename, os.path.join(directory, 'game_setting.yaml'))
+        started = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')],
+            cwd=directory, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        )
+        output = b''
+        elapsed = None
+        while True:
+            chunk = os.read(process.stdout.fileno(), 4096)
+            if not chunk:
+                break
+            output += chunk
+            if FIRST_PROMPT in output:
+                elapsed = time.perf_counter() - started
+                break
+        # An unknown name makes the game exit
+        process.communicate(b'\n')
+        return elapsed
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def benchmark_startup(runs, world_filename, provider):
+    '''Time cold starts: importing main, and starting the game up to its first prompt'''
+    env = dict(os.environ, AI_PROVIDER=provider, PYTHONUNBUFFERED='1')
+    import_seconds = []
+    prompt_seconds = []
+    for _ in range(runs):
+        probe = subprocess.run([sys.executable, '-c', IMPORT_PROBE], env=env, capture_output=True, text=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+        if probe.returncode != 0:
+            print(f'Error importing main: {probe.stderr.strip()}')
+            return
+        import_seconds.append(float(probe.stdout.strip().splitlines()[-1]))
+        elapsed = time_to_first_prompt(world_filename, env)
+        if elapsed is None:
+            print('Error: the game exited before its first prompt')
+            return
+        prompt_seconds.append(elapsed)
+    print(f'Startup ({runs} runs, {provider} provider):')
+    for label, values in (('import main', import_seconds), ('time to first prompt', prompt_seconds)):
+        print(f'  {label}: p50={percentile(values, 0.5) * 1000:.1f} ms, max={max(values) * 1000:.1f} ms')
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline latency benchmark for scripted game sessions.')
+    parser.add_argument('--world', default=DEFAULT_WORLD_FILENAME, help='Game setting YAML file')
+    parser.add_argument('--player', default='Roy', help='Name of the player character')
+    parser.add_argument('--sessions', type=int, default=10, help='Number of scripted sessions to run')
+    parser.add_argument('--provider', default='local', choices=['local', 'replay'])
+    parser.add_argument('--recording', default='replay.json', help='Recording file for the replay provider')
+    parser.add_argument('--latency', type=float, default=0.0, help='Simulated seconds before the first token')
+    parser.add_argument('--token-rate', type=float, default=None, help='Simulated streamed words per second')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Probability of an injected failure')
+    parser.add_argument('--entity-store', help='SQLite file to page character sheets and memories from')
+    parser.add_argument('--live-narration', action='store_true', help='Narrate arrivals and let characters greet first')
+    parser.add_argument('--prefetch-budget', type=int, default=0, help='Requests prefetched per location (0 disables)')
+    parser.add_argument('--think-time', type=float, default=0.0, help='Seconds the scripted player idles before each line')
+    parser.add_argument('--tick-populations', help='Comma-separated NPC counts to benchmark simulation ticks with, '
+                                                     'instead of running sessions')
+    parser.add_argument('--ticks', type=int, default=20, help='Simulation ticks per population')
+    parser.add_argument('--workers', type=int, default=4, help='Simulation worker threads')
+    parser.add_argument('--startup', type=int, default=0, help='Time this many cold starts of the game instead of '
+                                                               'running sessions')
+    parser.add_argument('--metrics', help='Write Prometheus metrics of the run to this file')
+    parser.add_argument('--trace', help='Write a JSON trace of the run to this file')
+    args = parser.parse_args()
+    if args.metrics or args.trace:
+        metrics.enable(trace=bool(args.trace))
+
+    if args.startup:
+        benchmark_startup(args.startup, args.world, args.provider)
+        return
+
+    game_data = load_world(args.world)
+    if game_data is None:
+        return
+
+    ai_service = AIService.from_config({
+        'provider': args.provider,
+        'recording_path': args.recording,
+        'latency': args.latency,
+        'token_rate': args.token_rate,
+        'failure_rate': args.failure_rate
+    })
+
+    if args.tick_populations:
+        populations = [int(population) for population in args.tick_populations.split(',')]
+        benchmark_ticks(populations, args.ticks, ai_service, args.workers)
+        background_runner.shutdown()
+        return
+
+    store = EntityStore(args.entity_store) if args.entity_store else None
+    tracemalloc.start()
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(args.sessions):
+        if args.live_narration:
+            # A fresh cache per session, so hits only come from prefetching
+            ai_service.cache = ResponseCache()
+        latencies.extend(run_session(game_data, ai_service, args.player, DEFAULT_SCRIPT, store, args.live_narration,
+                                     args.prefetch_budget, args.think_time))
+        background_runner.wait_all()
+    elapsed = time.perf_counter() - started
+    current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    background_runner.shutdown()
+
+    prompt_sizes = [prompt + system for prompt, system in ai_service.provider.requests]
+
+    print(f'Sessions: {args.sessions}, turns: {len(latencies)}, total: {elapsed:.3f}s')
+    print('Turn latency (ms): ' + ', '.join(
+        f'p{int(fraction * 100)}={percentile(latencies, fraction) * 1000:.2f}'
+        for fraction in (0.5, 0.9, 0.99)
+    ) + f', max={max(latencies, default=0) * 1000:.2f}')
+    print(f'LLM calls: {len(prompt_sizes)}, prompt size (chars): '
+          f'p50={percentile(prompt_sizes, 0.5):.0f}, max={max(prompt_sizes, default=0)}')
+    print(f'Allocations: current={current_bytes / 1024:.1f} KiB, peak={peak_bytes / 1024:.1f} KiB')
+    if args.metrics:
+        metrics.write_prometheus(args.metrics)
+    if args.trace:
+        metrics.write_trace(args.trace)
+
+if __name__ == '__main__':
+    main()
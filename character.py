@@ -1,6 +1,17 @@
-from setting import GEIMINI_SAFETY_SETTINGS
-import google.generativeai as genai
-import os
+import asyncio
+import sys
+from ai_service import Priority
+from background import background_runner
+from memory import MemoryStore
+from metrics import character_labels, metrics
+from prompt_builder import PromptBuilder
+
+MEMORY_PROMPT_SIZE = 3 # Memories injected into the system prompt
+MEMORY_MAX_ENTRIES = 200 # Compact memory once it grows past this
+MEMORY_COMPACT_BATCH = 50 # Oldest memories merged into one summary per compaction
+CHAT_FOLD_TURNS = 6 # Fold older dialogue into the running summary every this many turns
+CHAT_KEEP_TURNS = 2 # Most recent turns kept verbatim after a fold
+PROMPT_TOKEN_BUDGET = 1500 # Upper bound on the character system prompt, in approximate tokens
 
 BASE_SYSTEM_INSTRUCTIONS = '''
 System Notes for the Assistant: The assistant is designed to fully mimic {char} in both personality and behavior, creating immersive and realistic conversations. Responses must remain consistent with {char}'s traits, tone, and emotional state, regardless of the user’s input or tone.
@@ -30,113 +41,356 @@ Key Instructions:
 The assistant must always deliver responses that feel authentic, immersive, and true to {char}. Stay proactive, creative, and focused on enhancing the user’s experience through meaningful and character-driven interactions.
 '''
 
+SUMMARY_SYSTEM_INSTRUCTIONS = '''
+You are a scriptwriter tasked with summarizing dialogues between an AI and a user.
+Create a concise summary of their conversation in a single paragraph, limited to 100 words.
+Focus on the key points and themes discussed while maintaining clarity and coherence.
+'''
+
+MEMORY_ROLLUP_SYSTEM_INSTRUCTIONS = '''
+You are a scriptwriter keeping a character's long-term memory.
+Merge the following memories into a single paragraph of at most 150 words.
+Keep names, places, promises and relationship changes; drop small talk.
+'''
+
+# Stands in for the player's first line when the character speaks first
+GREETING_ACTION = '*approaches you*'
+
+prompt_builder = PromptBuilder(BASE_SYSTEM_INSTRUCTIONS, token_budget=PROMPT_TOKEN_BUDGET)
+
 # scenario and examples dailogue?
 
+def _sheet_field(key):
+    '''Property reading a field of the character sheet'''
+    def get(self):
+        return self.sheet.get(key)
+
+    def set(self, value):
+        if self._data is None or self._data is self._sheet_source:
+            # Keep the change on a private copy instead of the shared setting data
+            self._data = dict(self.sheet)
+        self._data[key] = value
+
+    return property(get, set)
+
 class Character:
-    def __init__(self, name, data):
-        self.name = name
-        self.age = data.get('age')
-        self.relationships = data.get('relationships', [])
-        self.appearance = data.get('appearance')
-        self.personality = data.get('personality')
-        self.activities_and_mannerisms = data.get('activities_and_mannerisms')
-        self.backstory = data.get('backstory')
-        self.location = data.get('location')
-        self.ai_config = data.get('ai_config')
-        self.current_interactions = [] # Use for building chat between user and AI
-        self.memory = []
+    '''
+    A player or non-player character
+
+    Sheet fields (age, personality, ...) are read from the setting data on
+    access instead of being copied, or paged in from an EntityStore when one
+    is given. The transcript, party and memory are only allocated once used,
+    so characters nobody talks to stay small.
+    '''
+
+    __slots__ = ('name', 'world_index', 'aibot', 'store', '_data', '_sheet_source', '_location', '_memory',
+                 '_memory_page', '_party', '_folding', 'current_interactions', 'running_summary', 'chat')
+
+    age = _sheet_field('age')
+    relationships = _sheet_field('relationships')
+    appearance = _sheet_field('appearance')
+    personality = _sheet_field('personality')
+    activities_and_mannerisms = _sheet_field('activities_and_mannerisms')
+    backstory = _sheet_field('backstory')
+    ai_config = _sheet_field('ai_config')
+
+    def __init__(self, name, data, aibot=None, world_index=None, store=None):
+        self.name = sys.intern(name)
+        self.world_index = world_index
+        self.aibot = aibot
+        self.store = store
+        # With a store the sheet is paged in when needed rather than kept here
+        self._data = None if store is not None else (data or {})
+        self._sheet_source = self._data
+        self._location = None
+        self._memory = None
+        self._memory_page = None
+        self._party = None
+        self.current_interactions = () # Turns of the current interaction not yet folded into running_summary
+        self.running_summary = ''
+        self.chat = None
+        self._folding = False # A fold of older turns is in flight
+        location = (data or {}).get('location')
+        self.location = sys.intern(location) if isinstance(location, str) else location
+
+    @property
+    def sheet(self):
+        if self._data is not None:
+            return self._data
+        return self.store.sheet(self.name) or {}
+
+    @property
+    def memory(self):
+        memory = self._memory
+        if memory is None:
+            if self.store is not None:
+                memory = self.store.load_memory(self)
+            else:
+                memory = MemoryStore()
+            self._memory = memory
+        elif self.store is not None:
+            self.store.touch(self)
+        return memory
+
+    @property
+    def has_memory(self):
+        '''False while memory was never used, so there is nothing to save'''
+        return self._memory is not None or self._memory_page is not None
+
+    @memory.setter
+    def memory(self, memory):
+        if self.store is not None:
+            self.store.attach_memory(self, memory)
+        self._memory = memory
+
+    @property
+    def party(self):
+        '''Names of characters travelling with this one'''
+        if self._party is None:
+            self._party = set()
+        return self._party
+
+    @property
+    def location(self):
+        return self._location
+
+    @location.setter
+    def location(self, destination):
+        origin = self._location
+        self._location = destination
+        if self.world_index is not None and origin != destination:
+            self.world_index.move(self.name, origin, destination)
 
     def move(self, destination, locations):
-        if destination in locations[destination].connections:
-            self.location = destination
-            return f'{self.name} moves from {self.location} to the {destination}.'
+        '''Moves to a directly connected location.'''
+        if destination in locations[self.location].connections:
+            origin, self.location = self.location, destination
+            return f'{self.name} moves from {origin} to the {destination}.'
         else:
             return f'{self.name} cannot go to {destination}, {self.location} is not connected with {destination}.'
 
-    # TODO: optimize prompt for character aibot and build chat between AI and user
-    def generate_response(self, player, interaction):
-        '''Generates dialogue and actions based on interaction and memory.'''
-        memory_string = ''
-        if self.memory:
-            memory_string = 'Here are some relevant memories:\n'
-            for mem in self.memory[-3:]: # Only use the last 3 memories
-                memory_string += f"- {mem['content']}\n"
-
+    def build_system_prompt(self, player, interaction=None):
+        '''Builds the system prompt from both character sheets, the conversation summary and relevant memories.'''
         # AI config, Scenario and example conversations
+        memories = [mem['content'] for mem in self.memory.relevant(interaction, MEMORY_PROMPT_SIZE)]
+        return prompt_builder.build(self, player, memories, self.running_summary)
 
-        system_prompt = f'''
-        [{BASE_SYSTEM_INSTRUCTIONS.format(char=self.name)}]
-        [{player.name}'s Description:
-           Name: {player.name}
-           Age: {player.age}
-           Appearance: {player.appearance}
-           Personality: {player.personality}
-           Activities And Mannerisms: {player.activities_and_mannerisms}
-           Backstory: {player.backstory}
-        ]
-        [{self.name}'s Description:
-           Name: {self.name}
-           Age: {self.age}
-           Appearance: {self.appearance}
-           Personality: {self.personality}
-           Activities And Mannerisms: {self.activities_and_mannerisms}
-           Backstory: {self.backstory}
-           Recent Memory: {memory_string}
-        ]
+    def start_chat(self, player, interaction=None):
+        '''Starts a chat session seeded with the turns not yet folded into the running summary.'''
+        self.chat = self.aibot.start_chat(
+            system_instruction=self.build_system_prompt(player, interaction),
+            history=self.current_interactions
+        )
+
+    def greeting_request(self, player):
+        '''Generation arguments for the opening line, shared with the prefetcher'''
+        return {
+            'prompt': f'{player.name}: {GREETING_ACTION}',
+            'max_tokens': 120,
+            'temperature': 1.0,
+            'system_instruction': self.build_system_prompt(player)
+        }
+
+    @metrics.timed('character.greet', character_labels)
+    def greet(self, player):
         '''
+        Opening line when the player walks up, recorded as the first turn of
+        the conversation. Returns None when generation fails.
+        '''
+        opener = self.aibot.generate_content(**self.greeting_request(player))
+        if not opener:
+            return None
+        self.record_turn(player, GREETING_ACTION, opener)
+        self.chat = None # Restart the chat with the greeting in its history
+        return opener
 
-        try:
-            genai.configure(api_key=os.environ.get('GOOGLE_API_KEY'))
-            gemini_model = genai.GenerativeModel(model_name=os.environ.get('MODEL_NAME'), safety_settings=GEIMINI_SAFETY_SETTINGS, system_instruction=system_prompt)
-            response = gemini_model.generate_content(
-                interaction,
-                generation_config=genai.types.GenerationConfig(
-                    max_output_tokens=300,
-                    temperature=1.0
-                )
-            )
-            return response.text
-        except Exception as e:
-            print(f"Error generating character's response: {e}")
+    @metrics.timed('character.generate_response', character_labels)
+    def generate_response(self, player, interaction):
+        '''Generates dialogue and actions based on interaction, the conversation so far and memory.'''
+        if self.chat is None:
+            self.start_chat(player, interaction)
+        response = self.chat.send_message(f'{player.name}: {interaction}', max_tokens=300, temperature=1.0)
+        if not response:
+            print("Error generating character's response")
             return '...'
+        return response
+
+    def generate_response_stream(self, player, interaction):
+        '''Generates dialogue and actions as a stream of text chunks.'''
+        if self.chat is None:
+            self.start_chat(player, interaction)
+        return self.chat.send_message_stream(f'{player.name}: {interaction}', max_tokens=300, temperature=1.0)
 
     # Create interaction object for interacting not only characters?
+    @metrics.timed('character.interact_with', character_labels)
     def interact_with(self, player, interaction):
-        '''Handles the interaction with the character.'''
+        '''Handles the interaction with the character, printing the response as it streams in.'''
+        chunks = []
+        for chunk in self.generate_response_stream(player, interaction):
+            print(chunk, end='', flush=True)
+            chunks.append(chunk)
+        response = ''.join(chunks)
+        if not response:
+            print("Error generating character's response")
+            response = '...'
+            print(response, end='')
+        print()
+
+        self.record_turn(player, interaction, response)
+        self.schedule_fold()
+
+    @metrics.timed('character.respond_async', character_labels)
+    async def respond_async(self, player, interaction):
+        '''
+        Returns the character's response without blocking the event loop (used by the game server).
+
+        Older turns are not folded here: the caller runs fold_interactions_async
+        on its own loop once begin_fold() says a fold is due.
+        '''
+        if self.chat is None:
+            self.start_chat(player, interaction)
+        response = await self.chat.send_message_async(f'{player.name}: {interaction}', max_tokens=300, temperature=1.0)
+        if not response:
+            print("Error generating character's response")
+            response = '...'
+        self.record_turn(player, interaction, response)
+        return response
+
+    def record_turn(self, player, interaction, response):
+        '''Adds a finished turn to the transcript; returns True when older turns should be folded.'''
+        if not self.current_interactions:
+            self.current_interactions = []
         self.current_interactions.append({ 'role': 'user', 'content': f'{player.name}: {interaction}' })
-        response = self.generate_response(player, interaction)
         self.current_interactions.append({ 'role': 'assistant', 'content': response })
+        return len(self.current_interactions) >= 2 * CHAT_FOLD_TURNS
 
-        print(response)
+    def format_interaction_history(self, interactions):
+        '''Formats the running summary and the given turns as text for summarization.'''
+        interaction_history = '\n'.join(
+            ', '.join(f"{key}: {value}" for key, value in interaction.items())
+            for interaction in interactions
+        )
+        if self.running_summary:
+            return f'Summary of the conversation so far: {self.running_summary}\n\n{interaction_history}'
+        return interaction_history
 
-    def end_ineraction(self):
-        '''End the interaction with character'''
-        system_prompt = f'''
-        You are a scriptwriter tasked with summarizing dialogues between an AI and a user.
-        Create a concise summary of their conversation in a single paragraph, limited to 100 words.
-        Focus on the key points and themes discussed while maintaining clarity and coherence.
+    def begin_fold(self):
+        '''Claims the fold of older turns; False when none is due or one is already running.'''
+        if self._folding or len(self.current_interactions) < 2 * CHAT_FOLD_TURNS:
+            return False
+        self._folding = True
+        return True
+
+    def schedule_fold(self):
+        '''Fold older turns on the background runner, so the player never waits on the summary'''
+        if self.begin_fold():
+            background_runner.submit(self.fold_interactions_async())
+
+    @metrics.timed('character.fold_interactions', character_labels)
+    async def fold_interactions_async(self):
         '''
+        Folds all but the last CHAT_KEEP_TURNS turns into the running summary.
 
-            if len(self.current_interactions) == 0:
+        The chat restarts on the next message with the new summary in its
+        system prompt, so the context sent per turn stays bounded. Turns taken
+        while the summary was generated are kept; if the interaction ended
+        meanwhile, the summary is dropped.
+        '''
+        try:
+            turns = self.current_interactions
+            older = turns[:-2 * CHAT_KEEP_TURNS]
+            if not older:
                 return
 
-            interaction_history = '\n'.join(
-                ', '.join(f"{key}: {value}" for key, value in interaction.items())
-                for interaction in self.current_interactions
+            summary = await self.aibot.generate_content_async(
+                self.format_interaction_history(older),
+                max_tokens=300,
+                temperature=1.0,
+                system_instruction=SUMMARY_SYSTEM_INSTRUCTIONS,
+                priority=Priority.BACKGROUND
             )
+            if not summary or self.current_interactions is not turns:
+                return # Try again after the next turn, or the interaction is over
+            self.running_summary = summary
+            # In place, so turns appended meanwhile by record_turn are kept
+            del turns[:len(older)]
+            self.chat = None
+        finally:
+            self._folding = False
 
-         try:
-            genai.configure(api_key=os.environ.get('GOOGLE_API_KEY'))
-            gemini_model = genai.GenerativeModel(model_name=os.environ.get('MODEL_NAME'), safety_settings=GEIMINI_SAFETY_SETTINGS, system_instruction=system_prompt)
-            response = gemini_model.generate_content(
-                interaction_history,
-                generation_config=genai.types.GenerationConfig(
-                    max_output_tokens=300,
-                    temperature=1.0
-                )
-            )
-            self.memory.append({ 'type': 'interaction', 'content': response.text })
-            self.current_interactions = []
-        except Exception as e:
-            print(f"Error ending character's interaction: {e}")
+    def take_interaction_history(self):
+        '''
+        Returns the running summary plus the unfolded turns as text and starts a fresh conversation.
+
+        At most CHAT_FOLD_TURNS turns are unfolded, so this stays small however long the conversation was.
+        '''
+        if len(self.current_interactions) == 0:
+            return None
+
+        interaction_history = self.format_interaction_history(self.current_interactions)
+        self.current_interactions = ()
+        self.running_summary = ''
+        self.chat = None
+        return interaction_history
+
+    @metrics.timed('character.end_ineraction', character_labels)
+    def end_ineraction(self):
+        '''End the interaction with character'''
+        interaction_history = self.take_interaction_history()
+        if interaction_history is None:
+            return
+
+        response = self.aibot.generate_content(
+            interaction_history,
+            max_tokens=300,
+            temperature=1.0,
+            system_instruction=SUMMARY_SYSTEM_INSTRUCTIONS,
+            priority=Priority.BACKGROUND
+        )
+        if not response:
+            print("Error ending character's interaction")
+            return
+        self.memory.append({ 'type': 'interaction', 'content': response })
+        self.compact_memory()
+
+    @metrics.timed('character.end_ineraction_async', character_labels)
+    async def end_ineraction_async(self, interaction_history):
+        '''
+        Summarize a finished interaction into memory without blocking the game loop.
+
+        Callers take interaction_history with take_interaction_history() before
+        submitting this, so a new interaction can start right away; the summary
+        is appended to memory once it arrives.
+        '''
+        if interaction_history is None:
+            return
+
+        # Summaries are not urgent, so they can be batched with other characters' summaries
+        response = await self.aibot.generate_content_batched(
+            interaction_history,
+            max_tokens=300,
+            temperature=1.0,
+            system_instruction=SUMMARY_SYSTEM_INSTRUCTIONS,
+            priority=Priority.BACKGROUND
+        )
+        if not response:
+            print("Error ending character's interaction")
+            return
+        self.memory.append({ 'type': 'interaction', 'content': response })
+        if len(self.memory) > MEMORY_MAX_ENTRIES:
+            await asyncio.to_thread(self.compact_memory)
+
+    def summarize_memories(self, text):
+        '''Merges several memories into one rolled-up summary.'''
+        return self.aibot.generate_content(
+            text,
+            max_tokens=300,
+            temperature=1.0,
+            system_instruction=MEMORY_ROLLUP_SYSTEM_INSTRUCTIONS,
+            priority=Priority.BACKGROUND
+        )
 
+    @metrics.timed('character.compact_memory', character_labels)
+    def compact_memory(self):
+        '''Rolls old memories into summaries once memory grows past MEMORY_MAX_ENTRIES.'''
+        self.memory.compact(self.summarize_memories, MEMORY_MAX_ENTRIES, MEMORY_COMPACT_BATCH)
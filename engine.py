@@ -0,0 +1,208 @@
+import asyncio
+import os
+import re
+from character import Character
+from intent import IntentParser
+from location import Location
+from metrics import metrics
+from save_journal import SaveJournal
+from util import load_game_state
+from world import LazyEntities
+from world_index import WorldIndex
+
+# Save names come from clients, so they must not be able to name a path outside the save directory
+SAVE_NAME_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,64}')
+
+COMMAND_VERBS = ('move', 'interact', 'look', 'invite', 'dismiss', 'save', 'load')
+
+def command_labels(action):
+    '''Metric labels for a command; unknown verbs share one label so typos do not grow the label set'''
+    verb = action.split(' ', 1)[0].lower()
+    return { 'verb': verb if verb in COMMAND_VERBS else 'invalid' }
+
+def move_player(player, characters, locations, world_index, destination):
+    '''Moves the player (and party) along the shortest path to destination; returns the narration.'''
+    if destination not in locations:
+        return f'{destination} does not exist.'
+    path = world_index.path(player.location, destination)
+    if path is None:
+        return f'There is no way from the {player.location} to the {destination}.'
+
+    lines = []
+    for step in path[1:]:
+        lines.append(player.move(step, locations))
+        # Party members follow the player hop by hop
+        for member_name in player.party:
+            characters[member_name].location = player.location
+    lines.append(f'You are now in the {player.location}. {locations[player.location].description}')
+    return '\n'.join(lines)
+
+def describe_surroundings(player, locations, world_index):
+    '''What the player sees with the look command.'''
+    lines = [locations[player.location].description, '', 'The characters in this location:']
+    lines += sorted(world_index.occupants(player.location))
+    lines += ['', f"From here you can go to: {', '.join(sorted(world_index.neighbours(player.location)))}"]
+    return '\n'.join(lines)
+
+def invite_to_party(player, world_index, member_name):
+    if not member_name:
+        return 'Who do you want to invite?'
+    if member_name == player.name or member_name not in world_index.occupants(player.location):
+        return f'{member_name} is not here.'
+    player.party.add(member_name)
+    return f'{member_name} joins your party.'
+
+def dismiss_from_party(player, member_name):
+    if not member_name:
+        return 'Who do you want to dismiss?'
+    if member_name not in player.party:
+        return f'{member_name} is not in your party.'
+    player.party.discard(member_name)
+    return f'{member_name} leaves your party.'
+
+class SharedWorld:
+    '''
+    World data shared read-only by every game session in a process
+
+    Locations and the connection graph are built once. Each session gets its
+    own characters and occupancy index, so sessions never see each other's
+    moves or memories.
+    '''
+
+    def __init__(self, game_data, aibot, store=None):
+        self.game_data = game_data
+        self.aibot = aibot
+        self.store = store
+        self.locations = LazyEntities(game_data.get('locations'), Location)
+        self.world_index = WorldIndex.from_setting(game_data)
+        if store is not None:
+            store.adopt_characters(game_data)
+        self.world_setting = game_data.get('world_description', 'A default world.')
+        self.intent_parser = IntentParser(self.locations, aibot)
+
+    def new_session_state(self):
+        '''Fresh characters and occupancy index for one session.'''
+        world_index = self.world_index.fork()
+        characters = LazyEntities(
+            self.game_data.get('characters'),
+            lambda char_name, char_data: Character(char_name, char_data, self.aibot, world_index, self.store)
+        )
+        return characters, world_index
+
+class GameSession:
+    '''
+    One player's game, driven one line of input at a time
+
+    This is the non-blocking counterpart of handle_player_action and
+    handle_character_interaction in main.py: every call returns the text to
+    show instead of printing it, and model calls are awaited so many sessions
+    can wait on the model at once. llm_slots bounds how many calls run at a time.
+    '''
+
+    def __init__(self, session_id, world: SharedWorld, player_name, llm_slots: asyncio.Semaphore,
+                 save_name=None, save_directory='saves'):
+        self.session_id = session_id
+        self.world = world
+        self.locations = world.locations
+        self.characters, self.world_index = world.new_session_state()
+        self.player = self.characters[player_name]
+        self.llm_slots = llm_slots
+        if save_name is not None and not (isinstance(save_name, str) and SAVE_NAME_PATTERN.fullmatch(save_name)):
+            raise ValueError(f'Invalid save name: {save_name!r}')
+        self.save_filename = os.path.join(save_directory, save_name or session_id)
+        # Owned by the session rather than shared, so it is released when the session closes
+        self.journal = SaveJournal(self.save_filename)
+        self.target = None # Character the player is interacting with
+        self.pending = set() # Background summaries not finished yet
+        self.lock = asyncio.Lock() # Input lines of one session are handled in order
+
+    def intro(self):
+        return f'{self.world.world_setting}\n\nYou find yourself in the {self.player.location}. ' \
+               f'{self.locations[self.player.location].description}'
+
+    async def handle(self, line):
+        '''Handles one line of player input and returns the response text.'''
+        async with self.lock:
+            if self.target is not None:
+                return await self._handle_interaction(line)
+            intent = await self.world.intent_parser.parse_async(line, self.player, self.world_index)
+            # Unresolved input becomes an empty command, so nothing is run on a guess
+            return await self._handle_action(intent.command)
+
+    @metrics.timed('command', lambda session, action: command_labels(action))
+    async def _handle_action(self, action):
+        action_parts = action.split(' ', 1)
+        verb = action_parts[0].lower()
+        object_name = action_parts[1].lower() if len(action_parts) > 1 else None
+        name = object_name.title() if object_name else None
+
+        if verb == 'move':
+            return move_player(self.player, self.characters, self.locations, self.world_index, name)
+        elif verb == 'interact':
+            if not name:
+                return 'Who do you want to interact with?'
+            if name == self.player.name:
+                return 'Can not interact with yourself'
+            if name not in self.characters or self.characters[name].location != self.player.location:
+                return f'{name} is not here.'
+            self.target = self.characters[name]
+            return f"What do you do with {name}? (Type 'back' to return)"
+        elif verb == 'look':
+            return describe_surroundings(self.player, self.locations, self.world_index)
+        elif verb == 'invite':
+            return invite_to_party(self.player, self.world_index, name)
+        elif verb == 'dismiss':
+            return dismiss_from_party(self.player, name)
+        elif verb == 'save':
+            await self.wait_pending()
+            os.makedirs(os.path.dirname(self.save_filename) or '.', exist_ok=True)
+            await asyncio.to_thread(self.journal.save, self.player, self.characters)
+            return 'Game saved.'
+        elif verb == 'load':
+            await self.wait_pending()
+            loaded_player = await asyncio.to_thread(
+                load_game_state, self.locations, self.characters, self.save_filename, self.journal
+            )
+            if not loaded_player:
+                return 'Failed to load game.'
+            self.player = loaded_player
+            return f'Game loaded.\nYou are in the {self.player.location}. {self.locations[self.player.location].description}'
+        return 'Invalid action.'
+
+    async def _handle_interaction(self, interaction):
+        target = self.target
+        if interaction.lower() == 'back':
+            self.target = None
+            # Take the transcript now and summarize it in the background; the player gets the prompt back right away
+            self._run_later(self._end_interaction(target, target.take_interaction_history()))
+            return f'You step away from {target.name}.'
+        async with self.llm_slots:
+            response = await target.respond_async(self.player, interaction)
+        if target.begin_fold():
+            # On this loop and under llm_slots, like every other model call of the session
+            self._run_later(self._fold_interactions(target))
+        return response
+
+    def _run_later(self, coro):
+        '''Run coro as a session task; wait_pending() waits for it'''
+        task = asyncio.create_task(coro)
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    async def _fold_interactions(self, target):
+        async with self.llm_slots:
+            await target.fold_interactions_async()
+
+    async def _end_interaction(self, target, interaction_history):
+        async with self.llm_slots:
+            await target.end_ineraction_async(interaction_history)
+
+    async def wait_pending(self):
+        '''Waits for background summaries so memories are complete.'''
+        if self.pending:
+            await asyncio.gather(*list(self.pending), return_exceptions=True)
+
+    async def close(self):
+        if self.target is not None:
+            await self._handle_interaction('back')
+        await self.wait_pending()
@@ -0,0 +1,228 @@
+from collections import OrderedDict
+from collections.abc import Mapping
+import hashlib
+import itertools
+import marshal
+import os
+import sqlite3
+import threading
+from memory import MemoryStore
+
+# Pinned so the store does not depend on the interpreter's default
+MARSHAL_VERSION = 4
+
+class EntityStore:
+    '''
+    SQLite-backed storage for character sheets and memories, for worlds too
+    large to keep in memory
+
+    Sheets are imported once per world (re-imported when the character data
+    changes) and paged in on demand through a small LRU. Memories are written
+    through to a private temporary database as they change, so only the
+    memories of the max_resident most recently used characters stay in
+    memory; the others are read back when next needed.
+    '''
+
+    def __init__(self, path: str, sheet_cache_size: int = 256, max_resident: int = 1024):
+        self.path = path
+        self.sheet_cache_size = sheet_cache_size
+        self.max_resident = max_resident
+        self._sheets = OrderedDict() # name -> sheet dict
+        self._resident = OrderedDict() # page -> character holding its memory in memory
+        self._pages = itertools.count(1)
+        self._count = None
+        self._lock = threading.RLock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS sheets (name TEXT PRIMARY KEY, location TEXT, data BLOB NOT NULL)'
+        )
+        # An empty file name attaches a temporary database that sqlite deletes on close
+        self._db.execute("ATTACH DATABASE '' AS scratch")
+        self._db.execute(
+            'CREATE TABLE scratch.memories (page INTEGER NOT NULL, position INTEGER NOT NULL, entry BLOB NOT NULL, '
+            'PRIMARY KEY (page, position))'
+        )
+        self._db.commit()
+
+    def import_characters(self, characters):
+        '''
+        Store the character sheets from setting data, unless this exact data was
+        imported before, and return a StoredSheets mapping to use in its place.
+        '''
+        encoded = {name: marshal.dumps(data or {}, MARSHAL_VERSION) for name, data in (characters or {}).items()}
+        digest = hashlib.sha256(marshal.dumps(sorted(encoded.items()), MARSHAL_VERSION)).hexdigest()
+        with self._lock:
+            row = self._db.execute("SELECT value FROM meta WHERE key = 'characters'").fetchone()
+            if row is None or row[0] != digest:
+                with self._db:
+                    self._db.execute('DELETE FROM sheets')
+                    self._db.executemany(
+                        'INSERT INTO sheets (name, location, data) VALUES (?, ?, ?)',
+                        ((name, (characters[name] or {}).get('location'), data) for name, data in encoded.items())
+                    )
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO meta (key, value) VALUES ('characters', ?)", (digest,)
+                    )
+            self._sheets.clear()
+            self._count = None
+        return StoredSheets(self)
+
+    def adopt_characters(self, game_data):
+        '''
+        Move the character sheets of game_data into the store, replacing
+        game_data['characters'] with a StoredSheets mapping so the parsed
+        sheets can be freed.
+        '''
+        characters = game_data.get('characters')
+        if not (isinstance(characters, StoredSheets) and characters.store is self):
+            game_data['characters'] = self.import_characters(characters)
+        return game_data['characters']
+
+    def sheet(self, name):
+        '''A character's sheet, or None when there is no such character'''
+        with self._lock:
+            sheet = self._sheets.get(name)
+            if sheet is not None:
+                self._sheets.move_to_end(name)
+                return sheet
+            row = self._db.execute('SELECT data FROM sheets WHERE name = ?', (name,)).fetchone()
+            if row is None:
+                return None
+            sheet = marshal.loads(row[0])
+            self._sheets[name] = sheet
+            while len(self._sheets) > self.sheet_cache_size:
+                self._sheets.popitem(last=False)
+            return sheet
+
+    def has_character(self, name):
+        with self._lock:
+            if name in self._sheets:
+                return True
+            return self._db.execute('SELECT 1 FROM sheets WHERE name = ?', (name,)).fetchone() is not None
+
+    def character_names(self):
+        with self._lock:
+            return [name for name, in self._db.execute('SELECT name FROM sheets ORDER BY rowid')]
+
+    def character_locations(self):
+        '''(name, location) of every character, without paging in the sheets'''
+        with self._lock:
+            return self._db.execute('SELECT name, location FROM sheets ORDER BY rowid').fetchall()
+
+    def character_count(self):
+        with self._lock:
+            if self._count is None:
+                self._count = self._db.execute('SELECT COUNT(*) FROM sheets').fetchone()[0]
+            return self._count
+
+    def load_memory(self, character):
+        '''Page a character's memories in'''
+        with self._lock:
+            page = self._page(character)
+            entries = [
+                marshal.loads(entry) for entry, in self._db.execute(
+                    'SELECT entry FROM scratch.memories WHERE page = ? ORDER BY position', (page,)
+                )
+            ]
+            memory = MemoryStore(entries)
+            memory.backing = MemoryPage(self, page)
+            self._make_resident(page, character)
+            return memory
+
+    def attach_memory(self, character, memory: MemoryStore):
+        '''Make memory the character's memory, replacing what was stored for it'''
+        entries = memory.to_list()
+        with self._lock:
+            page = self._page(character)
+            backing = MemoryPage(self, page)
+            backing.replace(entries)
+            memory.backing = backing
+            self._make_resident(page, character)
+
+    def touch(self, character):
+        '''Mark a character's memory as recently used'''
+        page = character._memory_page
+        with self._lock:
+            if page in self._resident:
+                self._resident.move_to_end(page)
+
+    def _page(self, character):
+        if character._memory_page is None:
+            character._memory_page = next(self._pages)
+        return character._memory_page
+
+    def _make_resident(self, page, character):
+        self._resident[page] = character
+        self._resident.move_to_end(page)
+        while len(self._resident) > self.max_resident:
+            _, evicted = self._resident.popitem(last=False)
+            # Everything is already written through, so dropping it is enough
+            evicted._memory = None
+
+    def _append_memory(self, page, position, entry):
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO scratch.memories (page, position, entry) VALUES (?, ?, ?)',
+                    (page, position, marshal.dumps(entry, MARSHAL_VERSION))
+                )
+
+    def _replace_memory(self, page, entries):
+        with self._lock:
+            with self._db:
+                self._db.execute('DELETE FROM scratch.memories WHERE page = ?', (page,))
+                self._db.executemany(
+                    'INSERT INTO scratch.memories (page, position, entry) VALUES (?, ?, ?)',
+                    ((page, position, marshal.dumps(entry, MARSHAL_VERSION)) for position, entry in enumerate(entries))
+                )
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+class MemoryPage:
+    '''Write-through target of one character's MemoryStore'''
+
+    __slots__ = ('store', 'page')
+
+    def __init__(self, store: EntityStore, page: int):
+        self.store = store
+        self.page = page
+
+    def append(self, position, entry):
+        self.store._append_memory(self.page, position, entry)
+
+    def replace(self, entries):
+        self.store._replace_memory(self.page, entries)
+
+class StoredSheets(Mapping):
+    '''Read-only mapping of character name -> sheet, paged in from an EntityStore'''
+
+    def __init__(self, store: EntityStore):
+        self.store = store
+
+    def __getitem__(self, name):
+        sheet = self.store.sheet(name)
+        if sheet is None:
+            raise KeyError(name)
+        return sheet
+
+    def __contains__(self, name):
+        return self.store.has_character(name)
+
+    def __iter__(self):
+        return iter(self.store.character_names())
+
+    def __len__(self):
+        return self.store.character_count()
+
+    def locations(self):
+        '''(name, location) pairs, without paging in every sheet'''
+        return self.store.character_locations()
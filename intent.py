@@ -0,0 +1,274 @@
+'''
+Free-text command parsing.
+
+Commands are resolved in tiers, cheapest first: the exact "verb object" form,
+then a local matcher (verb synonyms, filler words and fuzzy matching against
+the names of locations and of the characters around the player), and only
+when that is still ambiguous, a model classification that goes through the
+AIService response cache. Most input never reaches the model.
+'''
+from difflib import get_close_matches
+import re
+import threading
+from metrics import metrics
+
+# Phrases that mean each command verb (see engine.COMMAND_VERBS, plus quit), matched at the start of the input
+VERB_SYNONYMS = {
+    'move': ('move to', 'move', 'go to', 'go', 'walk to', 'walk', 'head to', 'head', 'travel to', 'travel',
+             'run to', 'enter', 'visit', 'return to', 'leave for'),
+    'interact': ('interact with', 'interact', 'talk to', 'talk with', 'talk', 'speak to', 'speak with', 'speak',
+                 'chat with', 'chat', 'ask', 'greet', 'approach', 'say hi to', 'say hello to', 'meet'),
+    'look': ('look around', 'look', 'examine', 'inspect', 'observe', 'survey', 'where am i', 'l'),
+    'invite': ('invite', 'recruit', 'ask to join', 'take along', 'bring along', 'bring'),
+    'dismiss': ('dismiss', 'send away', 'part ways with', 'leave behind', 'kick'),
+    'save': ('save game', 'save'),
+    'load': ('load game', 'load', 'restore'),
+    'quit': ('quit game', 'quit', 'exit'),
+}
+# Verbs that only input consisting of nothing but the verb or a synonym may trigger, never a guess
+GUARDED_VERBS = ('save', 'load', 'quit')
+# Shorter words are never fuzzy-matched: "rest" is not "forest" and "what" is not "chat"
+MIN_FUZZY_LENGTH = 5
+FILLER_WORDS = frozenset(('the', 'a', 'an', 'to', 'with', 'at', 'into', 'please', 'me', 'let', 'lets', "let's", 'i',
+                          'want', 'would', 'like', 'go', 'over', 'some', 'now', 'again'))
+
+INTENT_SYSTEM_INSTRUCTIONS = '''
+You turn a text adventure player's input into one game command.
+Answer with exactly one line: a verb from the given list followed by the exact name it applies to, or "none" if the input is not a command.
+'''
+
+_PUNCTUATION = re.compile(r"[^\w\s']+")
+
+def normalize(text):
+    '''Lowercase words without punctuation or repeated whitespace'''
+    return ' '.join(_PUNCTUATION.sub(' ', text.lower()).split())
+
+class Intent:
+    '''A parsed command and the tier that resolved it'''
+
+    __slots__ = ('verb', 'target', 'source')
+
+    def __init__(self, verb, target=None, source='exact'):
+        self.verb = verb
+        self.target = target
+        self.source = source # exact, local, model, or None when unresolved
+
+    @property
+    def command(self):
+        '''The command in the "verb object" form handle_player_action understands'''
+        if self.verb is None:
+            return ''
+        return f'{self.verb} {self.target}' if self.target else self.verb
+
+    def __repr__(self):
+        return f'Intent({self.verb!r}, {self.target!r}, {self.source!r})'
+
+class IntentParser:
+    '''
+    Tiered intent engine for player commands
+
+    The synonym pattern and the location name index are compiled once per
+    world; character names are matched against the occupants of the player's
+    location and the party, so lookups stay small however many characters the
+    world has. parse() only asks the model (aibot, optional) when the local
+    tiers find no verb or an ambiguous target. Per-tier counts are kept in
+    stats, and hit_rate is the share of input resolved without the model.
+    '''
+
+    def __init__(self, location_names, aibot=None, cutoff: float = 0.75, verb_cutoff: float = 0.8):
+        self.aibot = aibot
+        self.cutoff = cutoff
+        self.verb_cutoff = verb_cutoff
+        self._locations = {name.lower(): name for name in location_names}
+        self._synonyms = {phrase: verb for verb, phrases in VERB_SYNONYMS.items() for phrase in phrases}
+        # Longest phrases first, so "go to" wins over "go"
+        self._synonym_pattern = re.compile(
+            r'^(?:please )?(' + '|'.join(re.escape(phrase) for phrase in sorted(self._synonyms, key=len, reverse=True))
+            + r')(?: (.*))?$'
+        )
+        self._verb_words = sorted({verb for verb in self._synonyms.values() if verb not in GUARDED_VERBS} |
+                                  {phrase for phrase in self._synonyms if ' ' not in phrase and len(phrase) > 3 and
+                                   self._synonyms[phrase] not in GUARDED_VERBS})
+        self.stats = { 'exact': 0, 'local': 0, 'model': 0, 'unresolved': 0 }
+        self._lock = threading.Lock()
+
+    @property
+    def hit_rate(self):
+        '''Share of parsed input resolved without the model'''
+        total = sum(self.stats.values())
+        return (self.stats['exact'] + self.stats['local']) / total if total else 0.0
+
+    def __str__(self):
+        total = sum(self.stats.values())
+        return (f'Intents: {total} parsed, exact {self.stats["exact"]}, local {self.stats["local"]}, '
+                f'model {self.stats["model"]}, unresolved {self.stats["unresolved"]}, '
+                f'local hit rate {self.hit_rate:.0%}')
+
+    def _count(self, intent):
+        source = intent.source or 'unresolved'
+        with self._lock:
+            self.stats[source] += 1
+        metrics.increment('intents', source=source)
+        return intent
+
+    def _candidates(self, verb, player, world_index):
+        '''{lowercase name: name} of everything verb may apply to'''
+        if verb == 'move':
+            return self._locations
+        if verb == 'dismiss':
+            return {name.lower(): name for name in player.party}
+        if verb in ('interact', 'invite'):
+            return {name.lower(): name for name in world_index.occupants(player.location) if name != player.name}
+        return {}
+
+    def _match(self, text, names):
+        '''The name text refers to: exact, a whole word of it, or a close spelling; None when unclear'''
+        if not text:
+            return None
+        name = names.get(text)
+        if name is not None:
+            return name
+        text = ' '.join(word for word in text.split() if word not in FILLER_WORDS)
+        if not text:
+            return None
+        name = names.get(text)
+        if name is not None:
+            return name
+        # "charlie" for "Charlie Brown", "forest" for "Dark Forest"
+        partial = [name for key, name in names.items() if text in key.split() or key in text.split()]
+        if len(partial) == 1:
+            return partial[0]
+        if len(text) < MIN_FUZZY_LENGTH:
+            return None
+        close = get_close_matches(text, list(names), n=2, cutoff=self.cutoff)
+        if len(close) == 1 or (close and close[0] == text):
+            return names[close[0]]
+        # A misspelled word of a longer name, e.g. "forrest"
+        words = {}
+        for key, name in names.items():
+            for word in key.split():
+                words.setdefault(word, set()).add(name)
+        matched = set()
+        for word in text.split():
+            if len(word) < MIN_FUZZY_LENGTH:
+                continue
+            for close_word in get_close_matches(word, list(words), n=1, cutoff=self.cutoff):
+                matched |= words[close_word]
+        if len(matched) == 1:
+            return matched.pop()
+        return None
+
+    def _parse_locally(self, text, player, world_index):
+        '''Intent from the exact and local tiers, or None when the model has to decide'''
+        verb, _, rest = text.partition(' ')
+        if verb in VERB_SYNONYMS:
+            # The exact form, with the object name corrected when it is a near miss
+            if verb in GUARDED_VERBS:
+                # "quit game" is, but "save me" is not a request to save
+                return Intent(verb, None, 'exact') if self._synonyms.get(text) == verb else None
+            if verb == 'look':
+                return Intent(verb, None, 'exact')
+            target = self._match(rest, self._candidates(verb, player, world_index))
+            return Intent(verb, target or rest or None, 'exact')
+
+        guessed_verb = False
+        match = self._synonym_pattern.match(text)
+        if match is not None:
+            verb = self._synonyms[match.group(1)]
+            rest = match.group(2) or ''
+            if verb in GUARDED_VERBS and rest:
+                return None # "exit the forest" is not a request to quit
+        else:
+            # A misspelled verb, e.g. "intract dana"
+            close = []
+            if len(verb) >= MIN_FUZZY_LENGTH:
+                close = get_close_matches(verb, self._verb_words, n=1, cutoff=self.verb_cutoff)
+            if close:
+                verb = self._synonyms.get(close[0], close[0])
+                guessed_verb = True
+            else:
+                verb, rest = None, text
+
+        if verb is None:
+            # Just a name: going there, or talking to them
+            location = self._match(rest, self._locations)
+            person = self._match(rest, self._candidates('interact', player, world_index))
+            if location and not person:
+                return Intent('move', location, 'local')
+            if person and not location:
+                return Intent('interact', person, 'local')
+            return None
+
+        if verb in GUARDED_VERBS or verb == 'look':
+            return Intent(verb, None, 'local')
+        candidates = self._candidates(verb, player, world_index)
+        if not rest and not guessed_verb and verb == 'interact' and len(candidates) == 1:
+            # "talk" with only one other person around
+            return Intent(verb, next(iter(candidates.values())), 'local')
+        target = self._match(rest, candidates)
+        if target is None:
+            return None
+        return Intent(verb, target, 'local')
+
+    def _classification_request(self, text, player, world_index):
+        nearby = sorted(name for name in world_index.occupants(player.location) if name != player.name)
+        exits = sorted(world_index.neighbours(player.location))
+        verbs = [verb for verb in VERB_SYNONYMS if verb not in GUARDED_VERBS]
+        return {
+            'prompt': f'''Verbs: {', '.join(verbs)}
+Player location: {player.location}
+Locations reachable from here: {', '.join(exits) or 'none'}
+Characters here: {', '.join(nearby) or 'none'}
+Party: {', '.join(sorted(player.party)) or 'none'}
+Input: {text}
+Command:''',
+            'max_tokens': 20,
+            'temperature': 0.0,
+            'system_instruction': INTENT_SYSTEM_INSTRUCTIONS
+        }
+
+    def _read_classification(self, response, player, world_index):
+        '''Validate the model's answer against the same indexes the local tiers use'''
+        verb, _, rest = normalize(response or '').partition(' ')
+        if verb not in VERB_SYNONYMS or verb in GUARDED_VERBS:
+            return Intent(None, None, None)
+        if verb == 'look':
+            return Intent(verb, None, 'model')
+        target = self._match(rest, self._candidates(verb, player, world_index))
+        if target is None:
+            return Intent(None, None, None)
+        return Intent(verb, target, 'model')
+
+    @metrics.timed('intent.parse')
+    def parse(self, text, player, world_index):
+        '''Resolve free text to an Intent; its verb is None when nothing matched'''
+        text = normalize(text)
+        if not text:
+            return self._count(Intent(None, None, None))
+        intent = self._parse_locally(text, player, world_index)
+        if intent is None:
+            if self.aibot is None:
+                intent = Intent(None, None, None)
+            else:
+                response = self.aibot.generate_content(
+                    **self._classification_request(text, player, world_index)
+                )
+                intent = self._read_classification(response, player, world_index)
+        return self._count(intent)
+
+    @metrics.timed('intent.parse')
+    async def parse_async(self, text, player, world_index):
+        '''parse() for the event loop; only the model fallback is awaited'''
+        text = normalize(text)
+        if not text:
+            return self._count(Intent(None, None, None))
+        intent = self._parse_locally(text, player, world_index)
+        if intent is None:
+            if self.aibot is None:
+                intent = Intent(None, None, None)
+            else:
+                response = await self.aibot.generate_content_async(
+                    **self._classification_request(text, player, world_index)
+                )
+                intent = self._read_classification(response, player, world_index)
+        return self._count(intent)
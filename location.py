@@ -1,5 +1,9 @@
+import sys
+
 class Location:
+    __slots__ = ('name', 'description', 'connections')
+
     def __init__(self, name, data):
-        self.name = name
+        self.name = sys.intern(name)
         self.description = data.get('description')
-        self.connections = data.get('connections', [])
+        self.connections = frozenset(sys.intern(target) for target in data.get('connections') or ())
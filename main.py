@@ -1,16 +1,39 @@
 import os
-# TODO: switch to Google's new library(from google import genai)
-import google.generativeai as genai
 from dotenv import load_dotenv
-from util import load_data_from_yaml, save_game_state, load_game_state
-from character import Character
-from location import Location
+from ai_service import AIService
+from background import background_runner
+from entity_store import EntityStore
+from response_cache import ResponseCache
+from util import save_game_state, load_game_state, get_save_journal
+from save_journal import AutoSaver
+from simulation import WorldSimulation
+from narrator import Narrator
+from prefetch import Prefetcher
+from intent import IntentParser
+from engine import command_labels, move_player, describe_surroundings, invite_to_party, dismiss_from_party
+from metrics import metrics
+from world import StartupReport, build_world, load_world
 from setting import GEIMINI_SAFETY_SETTINGS
 
 GAME_SETTING_FILENAME = 'game_setting.yaml'
-
-def handle_player_action(player, characters, locations, action):
-    '''Handles player actions and their effects on the game world.'''
+RESPONSE_CACHE_FILENAME = '.cache/responses.sqlite3'
+
+def handle_player_action(player, characters, locations, action, world_index, narrator=None, greet=False):
+    '''
+    Handles player actions and their effects on the game world.
+
+    With a narrator, arriving somewhere is also narrated; with greet,
+    characters speak first when the player starts an interaction.
+    '''
+    target_name = run_command(player, characters, locations, action, world_index, narrator)
+    if target_name is not None:
+        # Outside the command span, which would otherwise include the player's typing;
+        # the greeting and every reply are timed on their own
+        handle_character_interaction(player, characters, target_name, greet)
+
+@metrics.timed('command', lambda player, characters, locations, action, *args, **kwargs: command_labels(action))
+def run_command(player, characters, locations, action, world_index, narrator=None):
+    '''Runs one command; returns the name of the character to interact with for interact, else None.'''
     action_parts = action.split(" ", 1)
     verb = action_parts[0].lower()
     if len(action_parts) > 1:
@@ -19,31 +42,27 @@ def handle_player_action(player, characters, locations, action):
         object_name = None
 
     if verb == 'move':
-        if object_name in locations:
-            print(player.move(object_name))
-            print(f'You are now in the {player.location}. {locations[player.location].description}')
-            # Move following characters
-            # TODO: Build party system
-            for char_name, char in characters.items():
-                if char != player and char.location == player.location:
-                    char.location = player.location
-        else:
-            print(f'{destination} does not exist.')
+        destination = object_name.title() if object_name else None
+        origin = player.location
+        print(move_player(player, characters, locations, world_index, destination))
+        if narrator is not None and player.location != origin:
+            print(narrator.describe_location(locations[player.location]))
     elif verb == 'interact':
         if object_name:
-            handle_character_interaction(player, characters, object_name)
-        else:
-            print('Who do you want to interact with?')
+            return object_name
+        print('Who do you want to interact with?')
     elif verb == 'look':
-        print(locations[player.location].description)
-        print('\nThe characters in this location:')
-        for ch_name, ch_data in characters.items():
-            if ch_data.location == player.location:
-                print(ch_name)
-
+        print(describe_surroundings(player, locations, world_index))
+    elif verb == 'invite':
+        print(invite_to_party(player, world_index, object_name.title() if object_name else None))
+    elif verb == 'dismiss':
+        print(dismiss_from_party(player, object_name.title() if object_name else None))
     elif verb == 'save':
+        # Pending memory summaries must land before the state is written
+        background_runner.wait_all()
         save_game_state(player, characters)
     elif verb == 'load':
+        background_runner.wait_all()
         loaded_player = load_game_state(locations, characters)
         if loaded_player:
             player = loaded_player
@@ -54,7 +73,7 @@ def handle_player_action(player, characters, locations, action):
     else:
         print('Invalid action.')
 
-def handle_character_interaction(player, characters, target_name):
+def handle_character_interaction(player, characters, target_name, greet=False):
     '''Handles detailed interactions with a specific character.'''
 
     char_name = target_name.title()
@@ -67,6 +86,11 @@ def handle_character_interaction(player, characters, target_name):
         print(f'{char_name} is not here.')
         return
 
+    if greet and not target_char.current_interactions:
+        opener = target_char.greet(player)
+        if opener:
+            print(opener)
+
     while True:
         interaction = input(f"What do you do with {char_name}? (Type 'back' to return): ")
         if interaction.lower() == 'back':
@@ -76,37 +100,59 @@ def handle_character_interaction(player, characters, target_name):
             target_char.interact_with(player, interaction)
         except Exception as e:
             print(f'Error generating response: {e}')
-    target_char.end_ineraction()
+    # The transcript is taken now, so the next command sees a finished interaction;
+    # it is summarized into memory in the background so the player returns to the prompt immediately
+    background_runner.submit(target_char.end_ineraction_async(target_char.take_interaction_history()))
+
+def create_ai_service():
+    '''Creates the AI service from environment settings.'''
+    # TODO: have a config decide what part use which agent
+    # TODO: switch to Google's new library(from google import genai)
+    return AIService.from_config({
+        'provider': os.environ.get('AI_PROVIDER') or 'google',
+        'api_key': os.environ.get('GOOGLE_API_KEY'),
+        'model_name': os.environ.get('MODEL_NAME'),
+        'safety_settings': GEIMINI_SAFETY_SETTINGS,
+        'cache': ResponseCache(disk_path=RESPONSE_CACHE_FILENAME),
+        'requests_per_minute': os.environ.get('REQUESTS_PER_MINUTE')
+    })
 
 def main():
     load_dotenv()
-    # TODO: Create AI agent class and have a config decide what part use which agent
-    genai.configure(api_key=os.environ.get('GOOGLE_API_KEY'))
-    gemini_model = genai.GenerativeModel(model_name=os.environ.get('MODEL_NAME'), safety_settings=GEIMINI_SAFETY_SETTINGS)
+    # Optional instrumentation, written out when the game ends
+    metrics_filename = os.environ.get('METRICS_FILE')
+    trace_filename = os.environ.get('TRACE_FILE')
+    if metrics_filename or trace_filename:
+        metrics.enable(trace=bool(trace_filename))
+    report = StartupReport()
+    with report.step('AI service'):
+        ai_service = create_ai_service()
 
     # Laod game setting from a YAML file
     # TODO: extend this flow. might leave the setting to YAML file.
     #       info to pure text file for RAG pipeline
-    game_data = load_data_from_yaml(GAME_SETTING_FILENAME)
+    with report.step('load world'):
+        game_data = load_world(GAME_SETTING_FILENAME, report=report)
     if game_data is None:
         exit()
 
-    # Create objects to store the info from game setting file
-    locations = {}
-    for loc_name, loc_data in game_data.get('locations', {}).items():
-        locations[loc_name] = Location(loc_name, loc_data)
-    characters = {}
-    for char_name, char_data in game_data.get('characters', {}).items():
-        characters[char_name] = Character(char_name, char_data)
+    # Locations and characters are built on first use; large worlds can keep sheets and memories in SQLite
+    entity_store_filename = os.environ.get('ENTITY_STORE')
+    with report.step('build world'):
+        store = EntityStore(entity_store_filename) if entity_store_filename else None
+        locations, characters, world_index = build_world(game_data, ai_service, store)
+    report.note('world size', f"{len(locations)} locations, {len(characters)} characters")
 
-    narrator = Narrator(gemini_model)
+    narrator = Narrator(ai_service)
 
     # Generate stating world description
     world_description = game_data.get('world_description', 'A default world.')
-    detailed_world_description = narrator.generate_world_setting(world_description)
     print('\nWorld Setting:')
-    print(detailed_world_description)
+    with report.step('world setting'):
+        detailed_world_description = narrator.generate_world_setting(world_description)
     print('-' * 20)
+    if os.environ.get('STARTUP_TIMING'):
+        print(report)
 
     player_name = input("Enter your character's name: ")
     if player_name in characters:
@@ -117,15 +163,64 @@ def main():
 
     print(f'\nYou find yourself in the {player.location}. {locations[player.location].description}')
 
+    # Optional background autosave, disabled unless AUTOSAVE_INTERVAL (seconds) is set
+    autosaver = None
+    autosave_interval = float(os.environ.get('AUTOSAVE_INTERVAL') or 0)
+    if autosave_interval > 0:
+        autosaver = AutoSaver(get_save_journal(), player, characters, autosave_interval)
+        autosaver.start()
+
+    # Optional off-screen simulation of the other characters, one tick after every command
+    simulation = None
+    if os.environ.get('SIMULATE_WORLD'):
+        simulation = WorldSimulation(characters, world_index, ai_service, player)
+
+    # Optional generated arrival narration and greetings, prefetched while the player is idle
+    live_narration = bool(os.environ.get('LIVE_NARRATION'))
+    prefetcher = None
+    prefetch_budget = int(os.environ.get('PREFETCH_BUDGET') or 0)
+    if live_narration and prefetch_budget > 0:
+        prefetcher = Prefetcher(ai_service, narrator, characters, locations, world_index, prefetch_budget)
+        prefetcher.schedule(player)
+
+    # Free-text commands are resolved locally when possible; the model is only asked about unclear ones
+    intent_parser = IntentParser(locations, None if os.environ.get('NO_INTENT_MODEL') else ai_service)
+
     while True:
-        user_input = input('What do you do? (e.g., interact, move, look, save, load, quit): ')
+        user_input = input('What do you do? (e.g., interact, move, look, invite, dismiss, save, load, quit): ')
 
-        # TODO: use AI to guess which kind of action user want to do. so we don't need to input keyword.
-        if user_input.lower() == 'quit':
+        intent = intent_parser.parse(user_input, player, world_index)
+        if intent.verb == 'quit':
             break
-
-        handle_player_action(player, characters, locations, user_input)
-
+        # Unresolved input becomes an empty command, so nothing is run on a guess
+        user_input = intent.command
+
+        if intent.verb in ('save', 'load'):
+            # Save and load need a world that is not mid-tick, and should not wait on speculative work
+            if simulation is not None:
+                simulation.wait()
+            if prefetcher is not None:
+                prefetcher.cancel()
+        handle_player_action(player, characters, locations, user_input, world_index,
+                             narrator if live_narration else None, live_narration)
+        if simulation is not None:
+            simulation.schedule_tick()
+        if prefetcher is not None:
+            prefetcher.schedule(player)
+
+    if autosaver:
+        autosaver.stop()
+    if simulation is not None:
+        simulation.shutdown()
+    if prefetcher is not None:
+        prefetcher.cancel()
+    background_runner.shutdown()
+    if metrics_filename:
+        metrics.write_prometheus(metrics_filename)
+    if trace_filename:
+        metrics.write_trace(trace_filename)
+    if os.environ.get('STARTUP_TIMING'):
+        print(intent_parser)
     print('\nThanks for playing')
 
 if __name__ == '__main__':
@@ -0,0 +1,152 @@
+from collections import Counter
+import heapq
+import math
+import re
+import threading
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9']+")
+
+STOPWORDS = frozenset('''
+a an and are as at be but by for from had has have he her him his i if in into is it its me my no not of on or
+our she so that the their them then there they this to was we were what when which who will with you your
+'''.split())
+
+def tokenize(text):
+    '''Lowercase word tokens with stopwords removed'''
+    return [token for token in TOKEN_PATTERN.findall(str(text or '').lower()) if token not in STOPWORDS]
+
+class MemoryStore:
+    '''
+    A character's memories with an incremental BM25 index for retrieval
+
+    Entries are dicts like {'type': 'interaction', 'content': '...'}. Appending
+    only indexes the new entry, so search() stays fast as memory grows. Old
+    entries can be rolled up into summaries with compact(). When backing is
+    set (see EntityStore), every change is also written through to it.
+    '''
+
+    def __init__(self, entries=None, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.version = 0 # Bumped on every change, for callers caching derived data
+        self.generation = 0 # Bumped when existing entries are rewritten (compaction)
+        self.backing = None
+        self._lock = threading.RLock()
+        self._rebuild(list(entries or []))
+
+    def _rebuild(self, entries):
+        self._entries = []
+        self._lengths = []
+        self._total_length = 0
+        self._postings = {} # term -> {entry index: term frequency}
+        for entry in entries:
+            self._index(entry)
+
+    def _index(self, entry):
+        doc_id = len(self._entries)
+        terms = Counter(tokenize(entry.get('content')))
+        self._entries.append(entry)
+        self._lengths.append(sum(terms.values()))
+        self._total_length += self._lengths[-1]
+        for term, frequency in terms.items():
+            self._postings.setdefault(term, {})[doc_id] = frequency
+
+    def append(self, entry):
+        with self._lock:
+            self._index(entry)
+            self.version += 1
+            if self.backing is not None:
+                self.backing.append(len(self._entries) - 1, entry)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(list(self._entries))
+
+    def __getitem__(self, index):
+        return self._entries[index]
+
+    def to_list(self):
+        '''Plain list of entries, for saving'''
+        with self._lock:
+            return list(self._entries)
+
+    def changes_since(self, generation: int, length: int):
+        '''
+        Entries added since a checkpoint, for saving only what is new.
+
+        Returns (generation, length, entries, reset). When the store was
+        compacted after the checkpoint, reset is True and entries holds every
+        entry instead of just the new ones.
+        '''
+        with self._lock:
+            if generation == self.generation and length <= len(self._entries):
+                return self.generation, len(self._entries), self._entries[length:], False
+            return self.generation, len(self._entries), list(self._entries), True
+
+    def recent(self, k: int = 3):
+        '''The k most recent entries, oldest first'''
+        with self._lock:
+            return self._entries[-k:] if k > 0 else []
+
+    def search(self, query, k: int = 3):
+        '''Return up to k entries ranked by BM25 relevance to query, best first'''
+        with self._lock:
+            count = len(self._entries)
+            if count == 0 or k <= 0:
+                return []
+            average_length = self._total_length / count or 1.0
+            base = self.k1 * (1 - self.b)
+            per_length = self.k1 * self.b / average_length
+            lengths = self._lengths
+            scores = {}
+            for term in set(tokenize(query)):
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                frequency_in_docs = len(postings)
+                idf = math.log(1 + (count - frequency_in_docs + 0.5) / (frequency_in_docs + 0.5))
+                weight = idf * (self.k1 + 1)
+                for doc_id, frequency in postings.items():
+                    score = weight * frequency / (frequency + base + per_length * lengths[doc_id])
+                    scores[doc_id] = scores.get(doc_id, 0.0) + score
+            # Ties go to the newer memory
+            best = heapq.nlargest(k, scores.items(), key=lambda item: (item[1], item[0]))
+            return [self._entries[doc_id] for doc_id, _ in best]
+
+    def relevant(self, query, k: int = 3):
+        '''Top-k relevant entries, topped up with the most recent ones when few match'''
+        with self._lock:
+            selected = self.search(query, k) if query else []
+            for entry in reversed(self._entries):
+                if len(selected) >= k:
+                    break
+                if not any(entry is chosen for chosen in selected):
+                    selected.append(entry)
+            return selected
+
+    def compact(self, summarize, max_entries: int = 200, batch_size: int = 50):
+        '''
+        Roll the oldest batch_size entries into a single summary entry while the
+        store holds more than max_entries.
+
+        Args:
+            summarize: Callable taking the text of the entries to merge and
+                       returning the summary text (or '' on failure)
+        '''
+        while len(self._entries) > max_entries:
+            with self._lock:
+                batch = self._entries[:batch_size]
+            text = '\n'.join(f"- {entry.get('content')}" for entry in batch)
+            summary = summarize(text)
+            if not summary:
+                return
+            with self._lock:
+                # Entries appended meanwhile are kept; only the summarized batch is replaced
+                remaining = self._entries[len(batch):]
+                self._rebuild([{ 'type': 'summary', 'content': summary }] + remaining)
+                self.version += 1
+                self.generation += 1
+                if self.backing is not None:
+                    self.backing.replace(self._entries)
@@ -0,0 +1,279 @@
+'''
+Instrumentation for hot paths: latency histograms, token counts, cache hits and errors.
+
+Disabled by default. While disabled, metrics.timed() wrappers only check one
+flag and call through, and metrics.span() hands back a shared no-op context,
+so instrumented code pays next to nothing. Enable it with metrics.enable()
+(main.py does when METRICS_FILE or TRACE_FILE is set), then export with
+write_prometheus() and write_trace().
+'''
+from collections import deque
+from contextlib import nullcontext
+import asyncio
+import contextvars
+import functools
+import inspect
+import json
+import math
+import os
+import threading
+import time
+from prompt_builder import count_tokens
+
+METRIC_PREFIX = 'adventure'
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, math.inf)
+
+_NULL_SPAN = nullcontext()
+# (site, labels) of the innermost attributing span, so token and cache counts
+# recorded deep inside AIService are labelled with the call site that caused them
+_caller = contextvars.ContextVar('metrics_caller', default=None)
+
+def _labels_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items() if value is not None))
+
+def _format_labels(labels_key, extra=()):
+    pairs = list(labels_key) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        (key, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in pairs
+    )
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+def _trace_thread_id():
+    '''Async tasks share a thread, so each gets its own lane in the trace'''
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    return id(task) if task is not None else threading.get_ident()
+
+class Span:
+    '''
+    One timed call; records its latency and whether it raised on exit
+
+    An attributing span also becomes the caller of everything recorded
+    inside it (see Metrics.caller_labels), inheriting the labels of the
+    enclosing caller, e.g. the character of an interaction.
+    '''
+
+    __slots__ = ('metrics', 'site', 'labels', 'attribute', 'started', 'token')
+
+    def __init__(self, metrics, site, labels, attribute=True):
+        self.metrics = metrics
+        self.site = site
+        self.labels = labels
+        self.attribute = attribute
+        self.token = None
+
+    def __enter__(self):
+        if self.attribute:
+            parent = _caller.get()
+            labels = dict(parent[1], **self.labels) if parent is not None else self.labels
+            self.token = _caller.set((self.site, labels))
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # GeneratorExit just means the consumer stopped reading a stream
+        error = exc_type is not None and not issubclass(exc_type, GeneratorExit)
+        self.metrics.observe(self.site, time.perf_counter() - self.started, self.started, error, **self.labels)
+        if self.token is not None:
+            try:
+                _caller.reset(self.token)
+            except ValueError:
+                pass # A generator finished in another context; that context never saw the change
+        return False
+
+class Metrics:
+    '''
+    Per call site (and optional labels such as the character) it keeps a
+    latency histogram and error count, plus free-form counters for tokens and
+    cache lookups. When tracing, every span is also kept as a Chrome trace
+    event (bounded by max_trace_events) for flame-style viewing in
+    chrome://tracing, Perfetto or speedscope.
+    '''
+
+    def __init__(self, max_trace_events: int = 100000):
+        self.enabled = False
+        self.tracing = False
+        self._histograms = {} # (site, labels) -> [bucket counts, sum of seconds, count]
+        self._counters = {} # (name, labels) -> value
+        self._trace = deque(maxlen=max_trace_events)
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def enable(self, trace: bool = True):
+        self.enabled = True
+        self.tracing = trace
+
+    def disable(self):
+        self.enabled = False
+        self.tracing = False
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+            self._trace.clear()
+            self._origin = time.perf_counter()
+
+    def span(self, site: str, attribute: bool = True, **labels):
+        '''Context manager timing the block under site'''
+        if not self.enabled:
+            return _NULL_SPAN
+        return Span(self, site, labels, attribute)
+
+    def timed(self, site: str, labels=None, attribute: bool = True):
+        '''
+        Decorator timing every call under site
+
+        labels, if given, is called with the function's arguments and returns
+        extra labels, e.g. lambda self, *args, **kwargs: {'character': self.name}.
+        Generator functions are timed until the generator is exhausted and
+        coroutine functions until the coroutine returns. With attribute=False
+        (for plumbing such as AIService) the span does not become the caller
+        that token and cache counts are labelled with.
+        '''
+        def decorate(fn):
+            def span_for(args, kwargs):
+                return Span(self, site, labels(*args, **kwargs) if labels else {}, attribute)
+
+            if inspect.isgeneratorfunction(fn):
+                def timed_generator(args, kwargs):
+                    with span_for(args, kwargs):
+                        yield from fn(*args, **kwargs)
+
+                @functools.wraps(fn)
+                def wrapper(*args, **kwargs):
+                    if not self.enabled:
+                        return fn(*args, **kwargs)
+                    return timed_generator(args, kwargs)
+            elif inspect.iscoroutinefunction(fn):
+                async def timed_coroutine(args, kwargs):
+                    with span_for(args, kwargs):
+                        return await fn(*args, **kwargs)
+
+                @functools.wraps(fn)
+                def wrapper(*args, **kwargs):
+                    if not self.enabled:
+                        return fn(*args, **kwargs)
+                    return timed_coroutine(args, kwargs)
+            else:
+                @functools.wraps(fn)
+                def wrapper(*args, **kwargs):
+                    if not self.enabled:
+                        return fn(*args, **kwargs)
+                    with span_for(args, kwargs):
+                        return fn(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def observe(self, site: str, seconds: float, started: float = None, error: bool = False, **labels):
+        '''Record one call of site that took seconds'''
+        key = (site, _labels_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = [[0] * len(LATENCY_BUCKETS), 0.0, 0]
+                self._histograms[key] = histogram
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    histogram[0][index] += 1
+                    break
+            histogram[1] += seconds
+            histogram[2] += 1
+            if error:
+                error_key = ('errors', key[1] + (('site', site),))
+                self._counters[error_key] = self._counters.get(error_key, 0) + 1
+            if self.tracing and started is not None:
+                self._trace.append({
+                    'name': site,
+                    'ph': 'X',
+                    'ts': (started - self._origin) * 1e6,
+                    'dur': seconds * 1e6,
+                    'pid': os.getpid(),
+                    'tid': _trace_thread_id(),
+                    'args': dict(key[1], error=error) if error else dict(key[1])
+                })
+
+    def increment(self, name: str, value: float = 1, **labels):
+        '''Add value to a counter'''
+        if not self.enabled:
+            return
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def caller_labels(self) -> dict:
+        '''site and labels of the innermost attributing span, e.g. {'site': 'character.greet', 'character': 'Charlie'}'''
+        caller = _caller.get()
+        if caller is None:
+            return { 'site': 'unattributed' }
+        site, labels = caller
+        return dict(labels, site=site)
+
+    def record_tokens(self, prompt: str, response: str, **labels):
+        '''Count approximate prompt and response tokens of a model call, per calling site'''
+        if not self.enabled:
+            return
+        labels = dict(self.caller_labels(), **labels)
+        self.increment('tokens', count_tokens(prompt or ''), direction='prompt', **labels)
+        self.increment('tokens', count_tokens(response or ''), direction='response', **labels)
+
+    def counter(self, name: str, **labels):
+        with self._lock:
+            return self._counters.get((name, _labels_key(labels)), 0)
+
+    def prometheus_text(self) -> str:
+        '''Everything recorded so far in the Prometheus text exposition format'''
+        with self._lock:
+            histograms = sorted((key, ([*buckets], total, count)) for key, (buckets, total, count) in self._histograms.items())
+            counters = sorted(self._counters.items())
+
+        lines = [
+            f'# HELP {METRIC_PREFIX}_latency_seconds Latency of instrumented calls',
+            f'# TYPE {METRIC_PREFIX}_latency_seconds histogram',
+        ]
+        for (site, labels_key), (buckets, total, count) in histograms:
+            labels_key = labels_key + (('site', site),)
+            cumulative = 0
+            for bound, bucket_count in zip(LATENCY_BUCKETS, buckets):
+                cumulative += bucket_count
+                le = '+Inf' if bound == math.inf else repr(bound)
+                lines.append(f'{METRIC_PREFIX}_latency_seconds_bucket{_format_labels(labels_key, [("le", le)])} {cumulative}')
+            lines.append(f'{METRIC_PREFIX}_latency_seconds_sum{_format_labels(labels_key)} {total}')
+            lines.append(f'{METRIC_PREFIX}_latency_seconds_count{_format_labels(labels_key)} {count}')
+
+        names = sorted({name for (name, _), _ in counters})
+        for name in names:
+            lines.append(f'# TYPE {METRIC_PREFIX}_{name}_total counter')
+            lines += [
+                f'{METRIC_PREFIX}_{name}_total{_format_labels(labels_key)} {value}'
+                for (counter_name, labels_key), value in counters if counter_name == name
+            ]
+        return '\n'.join(lines) + '\n'
+
+    def trace(self) -> dict:
+        '''The recorded spans as a Chrome trace'''
+        with self._lock:
+            return { 'traceEvents': list(self._trace), 'displayTimeUnit': 'ms' }
+
+    def write_prometheus(self, filename: str):
+        '''Write the Prometheus text atomically, as the node exporter textfile collector expects'''
+        temporary_filename = f'{filename}.tmp'
+        with open(temporary_filename, 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(temporary_filename, filename)
+
+    def write_trace(self, filename: str):
+        with open(filename, 'w') as f:
+            json.dump(self.trace(), f)
+
+# Shared by every instrumented module in the process
+metrics = Metrics()
+
+def character_labels(character, *args, **kwargs):
+    '''labels function for Character methods'''
+    return { 'character': character.name }
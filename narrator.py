@@ -1,22 +1,47 @@
-import google.generativeai as genai
+from metrics import metrics
 
 class Narrator:
     def __init__(self, aibot):
         """Initialize the Narrator with an AI bot instance."""
         self.aibot = aibot
 
-    def generate_world_setting(self, world_description):
-        '''Generate detail description from basic world setting.'''
+    @metrics.timed('narrator.world_setting')
+    def generate_world_setting(self, world_description, stream=True):
+        '''
+        Generate detail description from basic world setting.
+
+        With stream=True the description is printed as it is generated; the full
+        text is returned either way.
+        '''
         prompt = f'''Generate a more detailed description of a world described as: {world_description}. Include details about the environment, atmosphere, and any notable features.'''
-        try:
-            response = self.aibot.generate_content(
-                prompt,
-                generation_config=genai.types.GenerationConfig(
-                    max_output_tokens=300,
-                    temperature=1.0
-                )
-            )
-            return response.text
-        except Exception as e:
-            print(f'Error generating world description: {e}')
-            return 'A mysterious world.'
+        if not stream:
+            response = self.aibot.generate_content(prompt, max_tokens=300, temperature=1.0)
+        else:
+            chunks = []
+            for chunk in self.aibot.generate_content_stream(prompt, max_tokens=300, temperature=1.0):
+                print(chunk, end='', flush=True)
+                chunks.append(chunk)
+            response = ''.join(chunks)
+
+        if not response:
+            print('Error generating world description')
+            response = 'A mysterious world.'
+            if stream:
+                print(response, end='')
+        if stream:
+            print()
+        return response
+
+    @staticmethod
+    def location_request(location):
+        '''Generation arguments for the arrival narration of a location, shared with the prefetcher'''
+        return {
+            'prompt': f'''The player arrives at the {location.name}: {location.description} Narrate the arrival in two or three vivid sentences in the second person, without inventing characters.''',
+            'max_tokens': 150,
+            'temperature': 1.0
+        }
+
+    @metrics.timed('narrator.describe_location')
+    def describe_location(self, location):
+        '''Narration shown when the player arrives at a location; falls back to its plain description.'''
+        return self.aibot.generate_content(**self.location_request(location)) or location.description
@@ -0,0 +1,109 @@
+import asyncio
+import threading
+from ai_service import Priority
+from background import background_runner
+from metrics import metrics
+
+class Prefetcher:
+    '''
+    Speculatively generates what the player is likely to need next
+
+    After each command, schedule() queues, in order: opening lines of the
+    characters where the player is, arrival narration for the connected
+    locations, then opening lines of the characters there. Requests run on
+    the background runner at PREFETCH priority and land in the AIService
+    response cache, so the real request made when the player moves or starts
+    talking is a cache hit (or joins the prefetch still in flight).
+
+    At most budget uncached requests are made per location the player
+    visits, concurrency at a time. Moving elsewhere cancels whatever is
+    left for the previous location.
+    '''
+
+    def __init__(self, aibot, narrator, characters, locations, world_index, budget: int = 8,
+                 concurrency: int = 2):
+        self.aibot = aibot
+        self.narrator = narrator
+        self.characters = characters
+        self.locations = locations
+        self.world_index = world_index
+        self.budget = budget
+        self.concurrency = concurrency
+        self.generated = 0 # Requests made
+        self.skipped = 0 # Already cached
+        self.cancelled = 0 # Prefetch rounds abandoned because the player moved
+        self._location = None
+        self._future = None
+        self._lock = threading.Lock()
+        if aibot.cache is None:
+            print('Warning: prefetching without a response cache has no effect')
+
+    def _requests(self, player, location):
+        '''Candidate requests for a player standing at location, most likely needed first'''
+        def greetings(at):
+            for name in sorted(self.world_index.occupants(at)):
+                if name == player.name or name in player.party:
+                    continue
+                character = self.characters.get(name)
+                if character is not None and not character.current_interactions:
+                    yield lambda character=character: character.greeting_request(player)
+
+        yield from greetings(location)
+        neighbours = sorted(self.world_index.neighbours(location))
+        for neighbour in neighbours:
+            if neighbour in self.locations:
+                yield lambda neighbour=neighbour: self.narrator.location_request(self.locations[neighbour])
+        for neighbour in neighbours:
+            yield from greetings(neighbour)
+
+    def schedule(self, player):
+        '''
+        Start prefetching for the player's current location, cancelling the
+        round for the previous one. Does nothing if the player has not moved.
+        '''
+        location = player.location
+        with self._lock:
+            if location == self._location:
+                return self._future
+            self._cancel_pending()
+            self._location = location
+            self._future = background_runner.submit(self._run(player, location))
+            return self._future
+
+    def cancel(self):
+        '''Stop the current round, e.g. before saving'''
+        with self._lock:
+            self._cancel_pending()
+            self._future = None
+            self._location = None
+
+    def _cancel_pending(self):
+        '''Cancel the current round if it is still running, counting it as wasted'''
+        if self._future is not None and self._future.cancel():
+            self.cancelled += 1
+            metrics.increment('prefetch_cancelled')
+
+    async def _run(self, player, location):
+        slots = asyncio.Semaphore(self.concurrency)
+        tasks = []
+        for build_request in self._requests(player, location):
+            if len(tasks) >= self.budget:
+                break
+            request = build_request()
+            if self.aibot.is_cached(**request):
+                self.skipped += 1
+                continue
+            tasks.append(asyncio.ensure_future(self._prefetch(slots, request)))
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # Cancelling the round cancels requests that have not finished
+            for task in tasks:
+                task.cancel()
+
+    @metrics.timed('prefetch.request')
+    async def _prefetch(self, slots, request):
+        async with slots:
+            self.generated += 1
+            metrics.increment('prefetch_requests')
+            await self.aibot.generate_content_async(**request, priority=Priority.PREFETCH)
@@ -0,0 +1,143 @@
+from collections import OrderedDict
+import re
+import threading
+
+TOKEN_PATTERN = re.compile(r'\w+|[^\w\s]')
+
+SHEET_FIELDS = (
+    ('Age', 'age'),
+    ('Appearance', 'appearance'),
+    ('Personality', 'personality'),
+    ('Activities And Mannerisms', 'activities_and_mannerisms'),
+    ('Backstory', 'backstory'),
+)
+
+def count_tokens(text):
+    '''
+    Approximate token count computed locally (words and punctuation marks).
+
+    Close enough to the provider's tokenizer for budgeting, without a network call.
+    '''
+    return len(TOKEN_PATTERN.findall(text))
+
+def truncate_to_tokens(text, max_tokens):
+    '''Cut text down to roughly max_tokens, keeping the beginning'''
+    if max_tokens <= 0:
+        return ''
+    matches = list(TOKEN_PATTERN.finditer(text))
+    if len(matches) <= max_tokens:
+        return text
+    return text[:matches[max_tokens - 1].end()] + ' ...'
+
+def sheet_fingerprint(character):
+    '''Values of every character sheet field, used to detect sheet changes'''
+    return (character.name,) + tuple(getattr(character, attribute) for _, attribute in SHEET_FIELDS)
+
+def describe(character, extra_lines=()):
+    '''Format a character sheet as a prompt section'''
+    lines = [f"[{character.name}'s Description:", f'Name: {character.name}']
+    lines += [f'{label}: {getattr(character, attribute)}' for label, attribute in SHEET_FIELDS]
+    lines += list(extra_lines)
+    return '\n'.join(lines) + '\n]'
+
+class PromptBuilder:
+    '''
+    Builds character system prompts within a token budget
+
+    The static part (base instructions and both character sheets) is formatted
+    once per (character, player) pair and reused until a sheet changes. Full
+    prompts are cached too, so repeated turns with the same memories produce
+    an identical system instruction, which keeps pooled model handles and
+    provider-side context caches warm.
+
+    When a prompt is over budget, sections are trimmed from lowest priority:
+    memories first, then the player's sheet, then the character's sheet. The
+    base instructions and the conversation summary are never trimmed.
+    '''
+
+    def __init__(self, base_instructions, token_budget: int = 1500, max_entries: int = 256):
+        self.base_instructions = base_instructions
+        self.token_budget = token_budget
+        self.max_entries = max_entries
+        self._static = OrderedDict() # (character, player) -> (fingerprint, sections)
+        self._prompts = OrderedDict() # (character, player, memories, summary) -> prompt
+        self._lock = threading.Lock()
+
+    def _remember(self, cache, key, value):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > self.max_entries:
+            cache.popitem(last=False)
+
+    def _static_sections(self, character, player):
+        '''Formatted base, player and character sections with their token counts'''
+        key = (character.name, player.name)
+        fingerprint = (sheet_fingerprint(character), sheet_fingerprint(player))
+        cached = self._static.get(key)
+        if cached is not None and cached[0] == fingerprint:
+            self._static.move_to_end(key)
+            return cached[1]
+
+        base = f'[{self.base_instructions.format(char=character.name).strip()}]'
+        player_sheet = describe(player)
+        character_sheet = describe(character)
+        sections = {
+            'base': (base, count_tokens(base)),
+            'player': (player_sheet, count_tokens(player_sheet)),
+            'character': (character_sheet, count_tokens(character_sheet)),
+        }
+        # Sheet changed: prompts built from the old sheet are stale
+        for prompt_key in [prompt_key for prompt_key in self._prompts if prompt_key[:2] == key]:
+            del self._prompts[prompt_key]
+        self._remember(self._static, key, (fingerprint, sections))
+        return sections
+
+    def build(self, character, player, memories=(), summary=None):
+        '''
+        Build the system prompt for character talking with player.
+
+        Args:
+            memories: Memory texts to include, most important first
+            summary: Summary of the conversation so far, if any
+        '''
+        memories = tuple(memories)
+        with self._lock:
+            sections = self._static_sections(character, player)
+            prompt_key = (character.name, player.name, memories, summary)
+            prompt = self._prompts.get(prompt_key)
+            if prompt is not None:
+                self._prompts.move_to_end(prompt_key)
+                return prompt
+
+            prompt = self._assemble(sections, memories, summary)
+            self._remember(self._prompts, prompt_key, prompt)
+            return prompt
+
+    def _assemble(self, sections, memories, summary):
+        base, base_tokens = sections['base']
+        player_sheet, player_tokens = sections['player']
+        character_sheet, character_tokens = sections['character']
+        summary_section = f'[Conversation so far: {summary}]' if summary else ''
+        summary_tokens = count_tokens(summary_section)
+        memory_lines = [f'- {memory}' for memory in memories]
+        memory_tokens = [count_tokens(line) for line in memory_lines]
+
+        # Lowest priority first: drop memories, least relevant first
+        available = self.token_budget - base_tokens - summary_tokens - player_tokens - character_tokens
+        while memory_lines and sum(memory_tokens) > available:
+            memory_lines.pop()
+            memory_tokens.pop()
+        available -= sum(memory_tokens)
+
+        if available < 0:
+            player_sheet = truncate_to_tokens(player_sheet, player_tokens + available)
+            available = min(0, player_tokens + available)
+        if available < 0:
+            character_sheet = truncate_to_tokens(character_sheet, character_tokens + available)
+
+        parts = [base, player_sheet, character_sheet]
+        if memory_lines:
+            parts.append('[Here are some relevant memories:\n' + '\n'.join(memory_lines) + '\n]')
+        if summary_section:
+            parts.append(summary_section)
+        return '\n'.join(parts)
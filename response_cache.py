@@ -0,0 +1,158 @@
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+class ResponseCache:
+    '''
+    Two-tier cache for generated text: an in-memory LRU in front of an
+    optional on-disk SQLite store
+
+    Both tiers expire entries after ttl seconds. The disk tier is capped by
+    entry count and total size, evicting the oldest entries first.
+    '''
+
+    def __init__(self, max_entries: int = 256, disk_path: str = None, disk_max_entries: int = 10000,
+                 disk_max_bytes: int = 50 * 1024 * 1024, ttl: float = 7 * 24 * 60 * 60):
+        self.max_entries = max_entries
+        self.disk_path = disk_path
+        self.disk_max_entries = disk_max_entries
+        self.disk_max_bytes = disk_max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._disk_count = 0 # Running totals of the disk tier, so writes need not scan it
+        self._disk_bytes = 0
+        if disk_path:
+            self._open_disk(disk_path)
+
+    def _open_disk(self, disk_path: str):
+        directory = os.path.dirname(disk_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        try:
+            self._db = sqlite3.connect(disk_path, check_same_thread=False)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, size INTEGER NOT NULL)'
+            )
+            self._db.execute('CREATE INDEX IF NOT EXISTS responses_created ON responses (created)')
+            self._db.execute('DELETE FROM responses WHERE created < ?', (time.time() - self.ttl,))
+            self._db.commit()
+            self._refresh_disk_totals()
+        except sqlite3.Error as e:
+            print(f"Error opening response cache '{disk_path}': {e}")
+            self._db = None
+
+    @staticmethod
+    def make_key(provider: str, model: str, prompt: str, system_instruction: str = None,
+                 max_tokens: int = 300, temperature: float = 1.0) -> str:
+        '''Build a stable cache key from everything that affects the response'''
+        payload = json.dumps(
+            [provider, model, prompt, system_instruction, max_tokens, temperature],
+            ensure_ascii=False
+        )
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key: str):
+        '''Return the cached text for key, or None on a miss'''
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, created = entry
+                if now - created <= self.ttl:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._memory[key]
+
+            if self._db is not None:
+                try:
+                    row = self._db.execute(
+                        'SELECT value, created FROM responses WHERE key = ?', (key,)
+                    ).fetchone()
+                except sqlite3.Error as e:
+                    print(f'Error reading response cache: {e}')
+                    row = None
+                if row is not None and now - row[1] <= self.ttl:
+                    self._remember(key, row[0], row[1])
+                    self.hits += 1
+                    return row[0]
+
+            self.misses += 1
+            return None
+
+    def set(self, key: str, value: str):
+        '''Store value in both tiers'''
+        created = time.time()
+        with self._lock:
+            self._remember(key, value, created)
+            if self._db is None:
+                return
+            size = len(value.encode('utf-8'))
+            try:
+                replaced = self._db.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+                self._db.execute(
+                    'INSERT OR REPLACE INTO responses (key, value, created, size) VALUES (?, ?, ?, ?)',
+                    (key, value, created, size)
+                )
+                if replaced is None:
+                    self._disk_count += 1
+                else:
+                    self._disk_bytes -= replaced[0]
+                self._disk_bytes += size
+                if self._disk_count > self.disk_max_entries or self._disk_bytes > self.disk_max_bytes:
+                    self._evict_disk()
+                self._db.commit()
+            except sqlite3.Error as e:
+                print(f'Error writing response cache: {e}')
+                self._db.rollback()
+                self._refresh_disk_totals()
+
+    def _remember(self, key: str, value: str, created: float):
+        self._memory[key] = (value, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _refresh_disk_totals(self):
+        '''Recount the disk tier; only needed on open and after a failed write'''
+        try:
+            self._disk_count, self._disk_bytes = self._db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses'
+            ).fetchone()
+        except sqlite3.Error as e:
+            print(f'Error reading response cache: {e}')
+
+    def _evict_disk(self):
+        '''Drop the oldest disk entries until both caps are respected'''
+        while self._disk_count > self.disk_max_entries or self._disk_bytes > self.disk_max_bytes:
+            row = self._db.execute('SELECT key, size FROM responses ORDER BY created LIMIT 1').fetchone()
+            if row is None:
+                break
+            self._db.execute('DELETE FROM responses WHERE key = ?', (row[0],))
+            self._disk_count -= 1
+            self._disk_bytes -= row[1]
+
+    def clear(self):
+        '''Remove every entry from both tiers'''
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute('DELETE FROM responses')
+                self._db.commit()
+                self._disk_count = 0
+                self._disk_bytes = 0
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,247 @@
+import marshal
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+import yaml
+from memory import MemoryStore
+
+# Every record is framed as <payload length><crc32 of payload><marshal payload>
+RECORD_HEADER = struct.Struct('<II')
+# Pinned so save files do not depend on the interpreter's default
+MARSHAL_VERSION = 4
+
+def encode_record(record):
+    payload = marshal.dumps(record, MARSHAL_VERSION)
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+def read_records(filename):
+    '''
+    Yield the records in a journal or snapshot file.
+
+    The file is memory-mapped rather than read into memory. Reading stops at
+    the first torn or corrupt record, e.g. one cut short by a crash mid-write.
+    '''
+    try:
+        with open(filename, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                offset = 0
+                while offset + RECORD_HEADER.size <= len(data):
+                    length, checksum = RECORD_HEADER.unpack_from(data, offset)
+                    start = offset + RECORD_HEADER.size
+                    payload = data[start:start + length]
+                    if len(payload) < length or zlib.crc32(payload) != checksum:
+                        print(f"Warning: ignoring a damaged record at the end of '{filename}'")
+                        return
+                    yield marshal.loads(payload)
+                    offset = start + length
+    except FileNotFoundError:
+        return
+
+def built_characters(characters):
+    '''
+    (name, character) pairs to save.
+
+    Characters not yet built by a LazyEntities mapping still match the setting
+    file, so there is nothing to save for them.
+    '''
+    loaded_items = getattr(characters, 'loaded_items', None)
+    return loaded_items() if loaded_items else list(characters.items())
+
+class SaveJournal:
+    '''
+    Incremental game save: a compacted snapshot plus an append-only journal of deltas
+
+    save() only appends what changed since the previous save (location
+    changes and new memories), so its cost does not grow with the size of the
+    campaign. Once the journal outgrows compact_bytes, the next save writes a
+    fresh snapshot and empties the journal.
+    '''
+
+    def __init__(self, filename: str = 'save_game', compact_bytes: int = 1024 * 1024):
+        self.snapshot_filename = f'{filename}.snapshot'
+        self.journal_filename = f'{filename}.journal'
+        self.legacy_filename = f'{filename}.yaml' # Full YAML save written before the journal existed
+        self.compact_bytes = compact_bytes
+        self._checkpoints = None # char name -> (location, memory id, memory generation, memory length)
+        self._player_name = None
+        self._lock = threading.Lock()
+
+    def _checkpoint(self, char):
+        if not char.has_memory:
+            return (char.location, None, -1, 0)
+        memory = char.memory
+        generation, length, _, _ = memory.changes_since(-1, 0)
+        return (char.location, id(memory), generation, length)
+
+    def save(self, player, characters):
+        '''Persist the changes since the last save or load'''
+        with self._lock:
+            if self._checkpoints is None or self._journal_size() > self.compact_bytes:
+                self._write_snapshot(player, characters)
+                return
+
+            records = []
+            if player.name != self._player_name:
+                records.append({ 'op': 'player', 'name': player.name })
+            for char_name, char in built_characters(characters):
+                location, memory_id, generation, length = self._checkpoints.get(char_name, (None, None, -1, 0))
+                if char.location != location:
+                    records.append({ 'op': 'location', 'char': char_name, 'location': char.location })
+                if not char.has_memory:
+                    # Never used, so still empty: no need to allocate a store to find out
+                    self._checkpoints[char_name] = (char.location, memory_id, generation, length)
+                    continue
+                memory = char.memory
+                if memory_id != id(memory):
+                    generation = -1
+                generation, length, entries, reset = memory.changes_since(generation, length)
+                if reset:
+                    records.append({ 'op': 'memory_reset', 'char': char_name, 'entries': entries })
+                elif entries:
+                    records.append({ 'op': 'memory', 'char': char_name, 'entries': entries })
+                self._checkpoints[char_name] = (char.location, id(memory), generation, length)
+
+            if records:
+                with open(self.journal_filename, 'ab') as f:
+                    f.write(b''.join(encode_record(record) for record in records))
+                    f.flush()
+                    os.fsync(f.fileno())
+            self._player_name = player.name
+
+    def _journal_size(self):
+        try:
+            return os.path.getsize(self.journal_filename)
+        except OSError:
+            return 0
+
+    def _write_snapshot(self, player, characters):
+        '''Write the full state atomically and start an empty journal for it'''
+        checkpoints = {}
+        state = {}
+        for char_name, char in built_characters(characters):
+            if char.has_memory:
+                memory = char.memory
+                generation, length, entries, _ = memory.changes_since(-1, 0)
+                checkpoints[char_name] = (char.location, id(memory), generation, length)
+            else:
+                entries = []
+                checkpoints[char_name] = (char.location, None, -1, 0)
+            state[char_name] = { 'location': char.location, 'memory': entries }
+
+        snapshot_id = time.time_ns()
+        temporary_filename = f'{self.snapshot_filename}.tmp'
+        with open(temporary_filename, 'wb') as f:
+            f.write(encode_record({ 'op': 'snapshot', 'id': snapshot_id, 'player': player.name, 'characters': state }))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_filename, self.snapshot_filename)
+
+        # The journal names the snapshot it extends, so a stale journal left by a
+        # crash right here is ignored on load instead of being replayed twice
+        with open(self.journal_filename, 'wb') as f:
+            f.write(encode_record({ 'op': 'journal', 'snapshot': snapshot_id }))
+            f.flush()
+            os.fsync(f.fileno())
+
+        self._checkpoints = checkpoints
+        self._player_name = player.name
+
+    def _read_legacy(self):
+        '''The state in an old YAML save as a snapshot record, or None when there is none'''
+        try:
+            with open(self.legacy_filename, 'r') as f:
+                game_state = yaml.safe_load(f)
+        except FileNotFoundError:
+            return None
+        if not isinstance(game_state, dict) or not isinstance(game_state.get('player'), dict):
+            print(f"Error: '{self.legacy_filename}' is not a save file.")
+            return None
+        state = {
+            char_name: { 'location': char_data.get('location'), 'memory': list(char_data.get('memory') or []) }
+            for char_name, char_data in (game_state.get('characters') or {}).items()
+        }
+        player = game_state['player']
+        state[player['name']] = { 'location': player.get('location'), 'memory': list(player.get('memory') or []) }
+        return { 'op': 'snapshot', 'id': None, 'player': player['name'], 'characters': state }
+
+    def load(self, characters):
+        '''
+        Restore the saved state into characters.
+
+        Without a snapshot, an old YAML save of the same name is imported; the
+        next save then writes it out as a snapshot. Returns the player's name,
+        or None when there is no save.
+        '''
+        with self._lock:
+            snapshot = next(read_records(self.snapshot_filename), None)
+            if snapshot is None:
+                snapshot = self._read_legacy()
+                if snapshot is None:
+                    return None
+
+            player_name = snapshot['player']
+            state = snapshot['characters']
+            records = read_records(self.journal_filename)
+            header = next(records, None)
+            stale_journal = header is None or snapshot['id'] is None or header.get('snapshot') != snapshot['id']
+            if stale_journal:
+                records = iter(())
+            for record in records:
+                op = record['op']
+                if op == 'player':
+                    player_name = record['name']
+                    continue
+                char_state = state.setdefault(record['char'], { 'location': None, 'memory': [] })
+                if op == 'location':
+                    char_state['location'] = record['location']
+                elif op == 'memory':
+                    char_state['memory'].extend(record['entries'])
+                elif op == 'memory_reset':
+                    char_state['memory'] = record['entries']
+
+            self._checkpoints = {}
+            for char_name, char_state in state.items():
+                char = characters.get(char_name)
+                if char is None:
+                    print(f'Character {char_name} from save file not found in game data.')
+                    continue
+                char.location = char_state['location']
+                char.memory = MemoryStore(char_state['memory'])
+                self._checkpoints[char_name] = self._checkpoint(char)
+            self._player_name = player_name
+            if stale_journal:
+                self._checkpoints = None # Start over with a fresh snapshot on the next save
+            return player_name
+
+class AutoSaver:
+    '''Saves the game on a background thread every interval seconds'''
+
+    def __init__(self, journal: SaveJournal, player, characters, interval: float = 60.0):
+        self.journal = journal
+        self.player = player
+        self.characters = characters
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='autosave', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.journal.save(self.player, self.characters)
+            except Exception as e:
+                print(f'Error autosaving game: {e}')
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
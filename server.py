@@ -0,0 +1,215 @@
+'''
+Multi-session game server.
+
+Serves many players from one process over a small JSON-over-HTTP API:
+
+    POST   /sessions        {"player": "Roy", "save": "optional-save-name"} -> {"session": id, "output": text}
+    POST   /sessions/<id>   {"input": "look"}                               -> {"output": text}
+    DELETE /sessions/<id>                                                   -> {"output": text}
+    GET    /health                                                          -> {"sessions": n}
+    GET    /metrics                                                         -> Prometheus text (with --metrics)
+
+Usage:
+
+    python server.py --port 8080 --max-sessions 500 --max-llm-calls 64 --metrics
+'''
+import argparse
+import asyncio
+import json
+import time
+import uuid
+from dotenv import load_dotenv
+from engine import SAVE_NAME_PATTERN, GameSession, SharedWorld
+from entity_store import EntityStore
+from main import GAME_SETTING_FILENAME, create_ai_service
+from metrics import metrics
+from narrator import Narrator
+from world import load_world
+
+MAX_BODY_BYTES = 64 * 1024
+
+class GameServer:
+    '''
+    Hosts isolated GameSessions over a shared world
+
+    max_sessions caps concurrent sessions, max_llm_calls caps model calls in
+    flight across all sessions, and sessions idle for idle_timeout seconds
+    are closed.
+    '''
+
+    def __init__(self, world: SharedWorld, max_sessions: int = 500, max_llm_calls: int = 64,
+                 idle_timeout: float = 30 * 60):
+        self.world = world
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.llm_slots = asyncio.Semaphore(max_llm_calls)
+        self.sessions = {} # id -> GameSession
+        self.last_used = {} # id -> time of the last request
+
+    async def create_session(self, body):
+        player_name = str(body.get('player', '')).title()
+        if len(self.sessions) >= self.max_sessions:
+            return 503, { 'error': 'Too many sessions, try again later.' }
+        if player_name not in (self.world.game_data.get('characters') or {}):
+            return 404, { 'error': f'Player {player_name} not found in the game setting file' }
+        save_name = body.get('save')
+        if save_name is not None and not (isinstance(save_name, str) and SAVE_NAME_PATTERN.fullmatch(save_name)):
+            return 400, { 'error': 'Save names may only use letters, digits, "_" and "-" (at most 64)' }
+
+        session_id = uuid.uuid4().hex
+        session = GameSession(session_id, self.world, player_name, self.llm_slots, save_name=save_name)
+        self.sessions[session_id] = session
+        self.last_used[session_id] = time.monotonic()
+        return 201, { 'session': session_id, 'output': session.intro() }
+
+    async def handle_input(self, session_id, body):
+        session = self.sessions.get(session_id)
+        if session is None:
+            return 404, { 'error': 'Unknown session' }
+        self.last_used[session_id] = time.monotonic()
+        output = await session.handle(str(body.get('input', '')))
+        return 200, { 'output': output }
+
+    async def close_session(self, session_id):
+        session = self.sessions.pop(session_id, None)
+        self.last_used.pop(session_id, None)
+        if session is None:
+            return 404, { 'error': 'Unknown session' }
+        await session.close()
+        return 200, { 'output': 'Thanks for playing' }
+
+    async def route(self, method, path, body):
+        parts = [part for part in path.split('/') if part]
+        if method == 'GET' and parts == ['health']:
+            return 200, { 'sessions': len(self.sessions) }
+        if method == 'GET' and parts == ['metrics'] and metrics.enabled:
+            return 200, metrics.prometheus_text()
+        if parts[:1] == ['sessions']:
+            if method == 'POST' and len(parts) == 1:
+                return await self.create_session(body)
+            if method == 'POST' and len(parts) == 2:
+                return await self.handle_input(parts[1], body)
+            if method == 'DELETE' and len(parts) == 2:
+                return await self.close_session(parts[1])
+        return 404, { 'error': 'Not found' }
+
+    async def handle_connection(self, reader, writer):
+        '''Serves HTTP/1.1 requests on one connection, keeping it alive between requests.'''
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    break
+                request_line, *header_lines = head.decode('latin-1').split('\r\n')
+                try:
+                    method, path, version = request_line.split(' ', 2)
+                except ValueError:
+                    await self.respond(writer, 400, { 'error': 'Bad request' }, keep_alive=False)
+                    break
+                headers = {}
+                for line in header_lines:
+                    if ':' in line:
+                        key, value = line.split(':', 1)
+                        headers[key.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length') or 0)
+                if length > MAX_BODY_BYTES:
+                    await self.respond(writer, 413, { 'error': 'Request body too large' }, keep_alive=False)
+                    break
+                raw_body = await reader.readexactly(length) if length else b''
+                try:
+                    body = json.loads(raw_body) if raw_body else {}
+                except ValueError:
+                    body = None
+                if not isinstance(body, dict):
+                    status, payload = 400, { 'error': 'Body must be a JSON object' }
+                else:
+                    try:
+                        status, payload = await self.route(method.upper(), path, body)
+                    except Exception as e:
+                        print(f'Error handling {method} {path}: {e}')
+                        status, payload = 500, { 'error': 'Internal server error' }
+
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                await self.respond(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, payload, keep_alive):
+        '''Sends payload as JSON, or as plain text when it is a string'''
+        if isinstance(payload, str):
+            body = payload.encode('utf-8')
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        else:
+            body = json.dumps(payload).encode('utf-8')
+            content_type = 'application/json'
+        reason = {200: 'OK', 201: 'Created', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large',
+                  500: 'Internal Server Error', 503: 'Service Unavailable'}.get(status, '')
+        writer.write(
+            f'HTTP/1.1 {status} {reason}\r\n'
+            f'Content-Type: {content_type}\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + body
+        )
+        await writer.drain()
+
+    async def close_idle_sessions(self):
+        while True:
+            await asyncio.sleep(min(60, self.idle_timeout))
+            now = time.monotonic()
+            for session_id, last_used in list(self.last_used.items()):
+                if now - last_used > self.idle_timeout:
+                    await self.close_session(session_id)
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f'Game server listening on {host}:{port}')
+        sweeper = asyncio.create_task(self.close_idle_sessions())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            sweeper.cancel()
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the text adventure to many players at once.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--world', default=GAME_SETTING_FILENAME, help='Game setting YAML file')
+    parser.add_argument('--max-sessions', type=int, default=500, help='Maximum concurrent sessions')
+    parser.add_argument('--max-llm-calls', type=int, default=64, help='Maximum model calls in flight')
+    parser.add_argument('--idle-timeout', type=float, default=30 * 60, help='Seconds before an idle session is closed')
+    parser.add_argument('--entity-store', help='SQLite file to page character sheets and memories from')
+    parser.add_argument('--metrics', action='store_true', help='Record metrics and serve them on GET /metrics')
+    parser.add_argument('--trace', help='Write a JSON trace of instrumented calls to this file on shutdown')
+    args = parser.parse_args()
+    if args.metrics or args.trace:
+        metrics.enable(trace=bool(args.trace))
+
+    load_dotenv()
+    ai_service = create_ai_service()
+    game_data = load_world(args.world)
+    if game_data is None:
+        return
+
+    store = EntityStore(args.entity_store) if args.entity_store else None
+    world = SharedWorld(game_data, ai_service, store)
+    # Generated once and shared by every session
+    world.world_setting = Narrator(ai_service).generate_world_setting(world.world_setting, stream=False)
+
+    game_server = GameServer(world, args.max_sessions, args.max_llm_calls, args.idle_timeout)
+    try:
+        asyncio.run(game_server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.trace:
+            metrics.write_trace(args.trace)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+'''
+Off-screen simulation of non-player characters.
+
+Every tick, characters far from the player are advanced with cheap rules
+(wander along location connections, meet whoever shares their location),
+while the few near the player get a model-written activity, batched into as
+few calls as possible. Ticks run on their own thread so the command loop
+never waits for them.
+'''
+import asyncio
+import concurrent.futures
+import random
+import threading
+import time
+from ai_service import Priority
+from background import background_runner
+from character import MEMORY_MAX_ENTRIES
+from metrics import metrics
+from prompt_builder import describe
+
+SIMULATION_SYSTEM_INSTRUCTIONS = '''
+You narrate what a character is doing while the player is nearby but not talking to them.
+Answer with one or two sentences in the third person, consistent with the character sheet. Do not invent new characters.
+'''
+
+def plan_shard(shard, exits, seed, move_chance, meet_chance):
+    '''
+    Rule-based decisions for one shard of locations.
+
+    Args:
+        shard: [(location, [names])] for the characters to simulate
+        exits: {location: tuple of connected locations}
+
+    Returns (moves, meetings): [(name, origin, destination)] and
+    [(name, other name, location)]. Pure, so it can run in any worker pool,
+    including a ProcessPoolExecutor.
+    '''
+    rng = random.Random(seed)
+    moves = []
+    meetings = []
+    for location, names in shard:
+        location_exits = exits.get(location)
+        for name in names:
+            roll = rng.random()
+            if roll < move_chance and location_exits:
+                moves.append((name, location, location_exits[rng.randrange(len(location_exits))]))
+            elif roll < move_chance + meet_chance and len(names) > 1:
+                other = names[rng.randrange(len(names) - 1)]
+                if other == name:
+                    other = names[-1] # Skip over itself without a second draw
+                meetings.append((name, other, location))
+    return moves, meetings
+
+class TickReport:
+    '''What one tick did and how long it took'''
+
+    __slots__ = ('tick', 'simulated', 'near', 'moves', 'meetings', 'rule_seconds', 'model_seconds')
+
+    def __init__(self, tick):
+        self.tick = tick
+        self.simulated = 0
+        self.near = 0
+        self.moves = 0
+        self.meetings = 0
+        self.rule_seconds = 0.0
+        self.model_seconds = 0.0
+
+    def __str__(self):
+        return (f'Tick {self.tick}: {self.simulated} simulated, {self.near} near the player, '
+                f'{self.moves} moves, {self.meetings} meetings, rules {self.rule_seconds * 1000:.1f} ms, '
+                f'model {self.model_seconds * 1000:.1f} ms')
+
+class WorldSimulation:
+    '''
+    Level-of-detail simulation of non-player characters
+
+    Characters within near_distance hops of the player stay where they are
+    and, every near_interval ticks, get a model-written activity appended to
+    memory; those requests go through AIService.generate_content_batched at
+    BACKGROUND priority, so they are batched together and never hold up
+    dialogue. Everyone further away follows rules: each tick a character
+    moves to a random connected location with probability move_chance, or
+    meets someone sharing its location with probability meet_chance (which
+    records a relationship and a memory).
+
+    Locations are split into shards of about shard_size characters that are
+    planned in parallel on workers threads (or on the given executor).
+    The player, their party and anyone in a conversation are left alone.
+    '''
+
+    def __init__(self, characters, world_index, aibot=None, player=None, near_distance: int = 1,
+                 near_interval: int = 5, move_chance: float = 0.1, meet_chance: float = 0.02,
+                 shard_size: int = 2000, workers: int = 4, executor: concurrent.futures.Executor = None,
+                 seed: int = None):
+        self.characters = characters
+        self.world_index = world_index
+        self.aibot = aibot
+        self.player = player
+        self.near_distance = near_distance
+        self.near_interval = near_interval
+        self.move_chance = move_chance
+        self.meet_chance = meet_chance
+        self.shard_size = shard_size
+        self.ticks = 0
+        self.last_report = None
+        self._executor = executor or concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix='simulation')
+        self._owns_executor = executor is None
+        self._runner = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='simulation-tick')
+        self._pending = None
+        self._pending_lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._exits = {location: tuple(sorted(targets)) for location, targets in world_index.graph.items()}
+        self._lock = threading.Lock()
+        self._compacting = set() # Names whose memory is being compacted
+
+    def _excluded(self):
+        '''Names the simulation must not touch'''
+        if self.player is None:
+            return set()
+        return {self.player.name} | set(self.player.party)
+
+    def _busy(self, name):
+        '''In a conversation with the player; only checked for characters already built'''
+        loaded = getattr(self.characters, 'loaded', None)
+        character = loaded(name) if loaded is not None else self.characters.get(name)
+        return character is not None and (character.chat is not None or bool(character.current_interactions))
+
+    def _shards(self, occupancy):
+        shards = []
+        shard = []
+        size = 0
+        for location, names in occupancy.items():
+            shard.append((location, names))
+            size += len(names)
+            if size >= self.shard_size:
+                shards.append(shard)
+                shard = []
+                size = 0
+        if shard:
+            shards.append(shard)
+        return shards
+
+    @metrics.timed('simulation.tick')
+    def tick(self):
+        '''Advance the world by one tick and return a TickReport'''
+        with self._lock:
+            self.ticks += 1
+            report = TickReport(self.ticks)
+            excluded = self._excluded()
+            near_locations = set()
+            if self.player is not None and self.player.location is not None:
+                near_locations = set(self.world_index.distances(self.player.location, self.near_distance))
+
+            started = time.perf_counter()
+            distant = {}
+            near = []
+            for location, names in self.world_index.snapshot().items():
+                names = [name for name in names if name not in excluded]
+                if not names:
+                    continue
+                if location in near_locations:
+                    near += [(name, location) for name in names]
+                else:
+                    distant[location] = sorted(names)
+            report.simulated = sum(len(names) for names in distant.values())
+            report.near = len(near)
+
+            futures = [
+                self._executor.submit(
+                    plan_shard, shard, self._exits, self._random.getrandbits(64), self.move_chance, self.meet_chance
+                )
+                for shard in self._shards(distant)
+            ]
+            for future in futures:
+                moves, meetings = future.result()
+                self._apply(moves, meetings, report)
+            report.rule_seconds = time.perf_counter() - started
+
+            if near and self.aibot is not None and self.ticks % self.near_interval == 0:
+                started = time.perf_counter()
+                try:
+                    background_runner.submit(self._update_near(near)).result()
+                except Exception as e:
+                    print(f'Error simulating characters near the player: {e}')
+                report.model_seconds = time.perf_counter() - started
+
+            self.last_report = report
+            return report
+
+    def _apply(self, moves, meetings, report):
+        for name, origin, destination in moves:
+            if self._busy(name):
+                continue
+            character = self.characters[name]
+            # Skip characters that moved meanwhile (e.g. the player invited them along)
+            if character.location == origin:
+                character.location = destination
+                report.moves += 1
+        for name, other_name, location in meetings:
+            if self._busy(name) or self._busy(other_name):
+                continue
+            if self._meet(self.characters[name], other_name, location):
+                self._meet(self.characters[other_name], name, location)
+                report.meetings += 1
+
+    def _remember(self, character, entry):
+        '''Append to memory, compacting it in the background once it outgrows MEMORY_MAX_ENTRIES'''
+        character.memory.append(entry)
+        if len(character.memory) > MEMORY_MAX_ENTRIES and character.name not in self._compacting:
+            self._compacting.add(character.name)
+            background_runner.submit(self._compact(character))
+
+    async def _compact(self, character):
+        try:
+            await asyncio.to_thread(character.compact_memory)
+        finally:
+            self._compacting.discard(character.name)
+
+    def _meet(self, character, other_name, location):
+        '''Record that character met other_name; returns False when they already knew each other'''
+        relationships = list(character.relationships or [])
+        if any(isinstance(relation, dict) and relation.get('name') == other_name for relation in relationships):
+            return False
+        relationships.append({ 'name': other_name, 'type': 'acquaintance' })
+        character.relationships = relationships
+        self._remember(character, { 'type': 'event', 'content': f'Met {other_name} at the {location}.' })
+        return True
+
+    async def _update_near(self, near):
+        near = [(self.characters[name], location) for name, location in near if not self._busy(name)]
+        characters = [character for character, _ in near]
+        prompts = [
+            f"{describe(character)}\nRecent memories: "
+            f"{' '.join(entry['content'] for entry in character.memory.recent(2)) or 'none'}\n"
+            f'{character.name} is in the {location}. What is {character.name} doing now?'
+            for character, location in near
+        ]
+        # Submitted together, so the micro-batcher folds them into as few calls as possible. Not
+        # cached: an activity is only useful once and would push reusable responses out of the cache
+        activities = await asyncio.gather(*[
+            self.aibot.generate_content_batched(
+                prompt,
+                max_tokens=80,
+                temperature=1.0,
+                system_instruction=SIMULATION_SYSTEM_INSTRUCTIONS,
+                use_cache=False,
+                priority=Priority.BACKGROUND
+            )
+            for prompt in prompts
+        ])
+        for character, activity in zip(characters, activities):
+            if activity:
+                self._remember(character, { 'type': 'activity', 'content': activity })
+
+    def schedule_tick(self):
+        '''
+        Run a tick on the simulation thread without waiting for it. Does
+        nothing while the previous tick is still running; returns its future.
+        '''
+        with self._pending_lock:
+            if self._pending is not None and not self._pending.done():
+                return self._pending
+            self._pending = self._runner.submit(self._tick_safely)
+            return self._pending
+
+    def _tick_safely(self):
+        try:
+            return self.tick()
+        except Exception as e:
+            print(f'Error simulating the world: {e}')
+
+    def wait(self):
+        '''Wait for the scheduled tick, e.g. before saving'''
+        pending = self._pending
+        if pending is not None:
+            concurrent.futures.wait([pending])
+
+    def shutdown(self):
+        self.wait()
+        self._runner.shutdown()
+        if self._owns_executor:
+            self._executor.shutdown()
@@ -0,0 +1,215 @@
+from collections.abc import Mapping
+from contextlib import contextmanager
+import gc
+import hashlib
+import marshal
+import os
+import sys
+import threading
+import time
+import yaml
+from character import Character
+from location import Location
+from util import SafeLoader
+from world_index import WorldIndex
+
+# Bump when the layout of the compiled world cache changes
+WORLD_CACHE_FORMAT = 2
+WORLD_CACHE_DIRECTORY = '.cache'
+
+class StartupReport:
+    '''Collects how long each startup step took'''
+
+    def __init__(self):
+        self.steps = []
+        self.notes = []
+
+    @contextmanager
+    def step(self, label):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps.append((label, time.perf_counter() - started))
+
+    def note(self, label, value):
+        self.notes.append((label, value))
+
+    def __str__(self):
+        lines = ['Startup timing:']
+        lines += [f'  {label}: {seconds * 1000:.1f} ms' for label, seconds in self.steps]
+        lines += [f'  {label}: {value}' for label, value in self.notes]
+        return '\n'.join(lines)
+
+def intern_setting(data):
+    '''
+    Intern the names repeated across setting data (location and character
+    names, relationship types) in place, so each is stored once. marshal
+    keeps them interned, so the compiled cache loads them already shared.
+    '''
+    def intern(value):
+        return sys.intern(value) if isinstance(value, str) else value
+
+    locations = data.get('locations')
+    if isinstance(locations, dict):
+        for loc_data in locations.values():
+            if isinstance(loc_data, dict) and loc_data.get('connections'):
+                loc_data['connections'] = [intern(target) for target in loc_data['connections']]
+        data['locations'] = {intern(name): loc_data for name, loc_data in locations.items()}
+
+    characters = data.get('characters')
+    if isinstance(characters, dict):
+        for char_data in characters.values():
+            if not isinstance(char_data, dict):
+                continue
+            char_data['location'] = intern(char_data.get('location'))
+            for relationship in char_data.get('relationships') or ():
+                if isinstance(relationship, dict):
+                    for key in ('name', 'type'):
+                        if key in relationship:
+                            relationship[key] = intern(relationship[key])
+        data['characters'] = {intern(name): char_data for name, char_data in characters.items()}
+    return data
+
+def world_cache_filename(filename, cache_directory=WORLD_CACHE_DIRECTORY):
+    return os.path.join(cache_directory, os.path.basename(filename) + '.world')
+
+def load_world(filename, cache_directory=WORLD_CACHE_DIRECTORY, report=None):
+    '''
+    Loads a game setting file through a compiled cache.
+
+    The parsed data is cached in a binary file next to the other caches. The
+    cache is used as long as the source file's mtime and size are unchanged,
+    or its content hash still matches. Otherwise the YAML is parsed again,
+    with the C loader when PyYAML was built with libyaml.
+
+    Returns the game data, or None when the file is missing or invalid.
+    '''
+    cache_filename = world_cache_filename(filename, cache_directory)
+    try:
+        source_stat = os.stat(filename)
+    except FileNotFoundError:
+        print(f"Error: File '{filename}' not found.")
+        return None
+
+    cached = None
+    # Unmarshalling builds many small containers; pausing the cyclic GC meanwhile roughly halves the time
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        with open(cache_filename, 'rb') as f:
+            cached = marshal.loads(f.read())
+        if cached.get('format') != WORLD_CACHE_FORMAT:
+            cached = None
+    except (OSError, EOFError, ValueError, TypeError, AttributeError):
+        cached = None
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    if cached and cached['mtime_ns'] == source_stat.st_mtime_ns and cached['size'] == source_stat.st_size:
+        if report is not None:
+            report.note('world cache', 'hit')
+        return cached['data']
+
+    with open(filename, 'rb') as f:
+        source = f.read()
+    digest = hashlib.sha256(source).hexdigest()
+    if cached and cached['sha256'] == digest:
+        # Touched but unchanged: keep the data, refresh the stat fields
+        data = cached['data']
+        if report is not None:
+            report.note('world cache', 'hit (content hash)')
+    else:
+        try:
+            data = yaml.load(source, Loader=SafeLoader)
+        except yaml.YAMLError as e:
+            print(f"Error: Invalid YAML format in '{filename}': {e}")
+            return None
+        if isinstance(data, dict):
+            intern_setting(data)
+        if report is not None:
+            report.note('world cache', f'miss (parsed with {SafeLoader.__name__})')
+
+    try:
+        os.makedirs(cache_directory, exist_ok=True)
+        temporary_filename = f'{cache_filename}.tmp'
+        with open(temporary_filename, 'wb') as f:
+            marshal.dump({
+                'format': WORLD_CACHE_FORMAT,
+                'mtime_ns': source_stat.st_mtime_ns,
+                'size': source_stat.st_size,
+                'sha256': digest,
+                'data': data
+            }, f)
+        os.replace(temporary_filename, cache_filename)
+    except (OSError, ValueError) as e:
+        # Data marshal cannot encode (e.g. YAML timestamps) just skips the cache
+        print(f'Warning: could not write world cache: {e}')
+    return data
+
+class LazyEntities(Mapping):
+    '''
+    Read-only mapping of entity name -> object, built on first access
+
+    Holds the raw setting data and calls factory(name, data) the first time an
+    entity is looked up, so large worlds only pay for the entities that are
+    actually used. Iterating over keys is free; iterating over values or items
+    builds every entity.
+    '''
+
+    def __init__(self, raw, factory):
+        self._raw = raw or {}
+        self._factory = factory
+        self._loaded = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        entity = self._loaded.get(name)
+        if entity is not None:
+            return entity
+        with self._lock:
+            entity = self._loaded.get(name)
+            if entity is None:
+                entity = self._factory(name, self._raw[name])
+                self._loaded[name] = entity
+            return entity
+
+    def __contains__(self, name):
+        return name in self._raw
+
+    def __iter__(self):
+        return iter(self._raw)
+
+    def __len__(self):
+        return len(self._raw)
+
+    def raw(self, name):
+        '''Setting data for an entity, without building it'''
+        return self._raw[name]
+
+    def loaded(self, name):
+        '''The entity if it was built already, without building it'''
+        return self._loaded.get(name)
+
+    def loaded_items(self):
+        '''(name, entity) pairs for the entities built so far'''
+        return list(self._loaded.items())
+
+def build_world(game_data, aibot, store=None):
+    '''
+    Creates lazily built locations and characters from game setting data,
+    plus the index of who is where and how locations connect.
+
+    With an EntityStore, the character sheets are moved into it (see
+    EntityStore.adopt_characters) and paged in when needed.
+    '''
+    world_index = WorldIndex.from_setting(game_data)
+    locations = LazyEntities(game_data.get('locations'), Location)
+    if store is not None:
+        store.adopt_characters(game_data)
+    characters = LazyEntities(
+        game_data.get('characters'),
+        lambda char_name, char_data: Character(char_name, char_data, aibot, world_index, store)
+    )
+    return locations, characters, world_index
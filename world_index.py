@@ -0,0 +1,131 @@
+from collections import OrderedDict, deque
+import threading
+
+class WorldIndex:
+    '''
+    Who is where, plus a navigation graph over location connections
+
+    Characters report every location change through move(), so finding the
+    occupants of a location never scans the whole cast. Shortest paths are
+    computed with a breadth-first search per origin and cached, since the
+    connection graph does not change during a game.
+    '''
+
+    def __init__(self, connections=None, max_cached_origins: int = 128):
+        self.graph = {name: frozenset(targets or ()) for name, targets in (connections or {}).items()}
+        self.max_cached_origins = max_cached_origins
+        self._occupants = {}
+        self._paths = OrderedDict() # origin -> {location: previous location on a shortest path}
+        self._paths_lock = threading.Lock()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_setting(cls, game_data):
+        '''Builds the index straight from game setting data, without building any entity.'''
+        index = cls({
+            loc_name: (loc_data or {}).get('connections')
+            for loc_name, loc_data in (game_data.get('locations') or {}).items()
+        })
+        characters = game_data.get('characters') or {}
+        if hasattr(characters, 'locations'):
+            # Stored sheets: read the locations without paging every sheet in
+            for char_name, location in characters.locations():
+                index.move(char_name, None, location)
+            return index
+        for char_name, char_data in characters.items():
+            index.move(char_name, None, (char_data or {}).get('location'))
+        return index
+
+    def fork(self):
+        '''
+        A copy with its own occupants that shares the connection graph and path
+        cache, for game sessions playing in the same world.
+        '''
+        index = WorldIndex(max_cached_origins=self.max_cached_origins)
+        index.graph = self.graph
+        index._paths = self._paths
+        index._paths_lock = self._paths_lock
+        with self._lock:
+            index._occupants = {location: set(names) for location, names in self._occupants.items()}
+        return index
+
+    def move(self, name, origin, destination):
+        '''Records that name went from origin to destination (either may be None).'''
+        with self._lock:
+            if origin is not None:
+                occupants = self._occupants.get(origin)
+                if occupants is not None:
+                    occupants.discard(name)
+            if destination is not None:
+                self._occupants.setdefault(destination, set()).add(name)
+
+    def occupants(self, location):
+        '''Names of everyone currently at location.'''
+        with self._lock:
+            return set(self._occupants.get(location, ()))
+
+    def neighbours(self, location):
+        return self.graph.get(location, frozenset())
+
+    def snapshot(self):
+        '''Copy of {location: names} for every occupied location'''
+        with self._lock:
+            return {location: set(names) for location, names in self._occupants.items() if names}
+
+    def distances(self, origin, max_distance):
+        '''{location: number of hops} for every location within max_distance of origin'''
+        distances = {origin: 0}
+        frontier = [origin]
+        for distance in range(1, max_distance + 1):
+            next_frontier = []
+            for location in frontier:
+                for neighbour in self.graph.get(location, ()):
+                    if neighbour not in distances:
+                        distances[neighbour] = distance
+                        next_frontier.append(neighbour)
+            frontier = next_frontier
+        return distances
+
+    def _previous_steps(self, origin):
+        '''Breadth-first search tree from origin, cached per origin.'''
+        with self._paths_lock:
+            previous = self._paths.get(origin)
+            if previous is not None:
+                self._paths.move_to_end(origin)
+                return previous
+
+        previous = {origin: None}
+        queue = deque([origin])
+        while queue:
+            location = queue.popleft()
+            for neighbour in self.graph.get(location, ()):
+                if neighbour not in previous:
+                    previous[neighbour] = location
+                    queue.append(neighbour)
+
+        with self._paths_lock:
+            self._paths[origin] = previous
+            while len(self._paths) > self.max_cached_origins:
+                self._paths.popitem(last=False)
+        return previous
+
+    def reachable(self, origin):
+        '''Every location that can be reached from origin, origin included.'''
+        return set(self._previous_steps(origin))
+
+    def path(self, origin, destination):
+        '''
+        Shortest list of locations from origin to destination, both included.
+
+        Returns None when destination cannot be reached.
+        '''
+        previous = self._previous_steps(origin)
+        if destination not in previous:
+            return None
+        steps = []
+        location = destination
+        while location is not None:
+            steps.append(location)
+            location = previous[location]
+        steps.reverse()
+        return steps